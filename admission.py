@@ -0,0 +1,141 @@
+import asyncio
+import math
+import threading
+import time
+
+
+class Rejected(Exception):
+    def __init__(self, status: int, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class AdmissionController:
+    # Bounded queue in front of the assistant. At most max_concurrent
+    # questions run at once and at most max_queue wait behind them. A new
+    # request is refused with 429 straight away when the queue is full or
+    # the estimated wait (from an average of recent service times) is past
+    # its deadline; a request that reaches its deadline while still queued
+    # gets 503 instead of being started.
+    def __init__(self, max_concurrent: int = 1, max_queue: int = 16, deadline: float = 60, smoothing: float = 0.2):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.deadline = deadline
+        self.smoothing = smoothing
+        self.service_time = None
+        self.waiting = 0
+        self.running = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_concurrent)
+        self._async_slots = None
+
+    def estimated_wait(self):
+        # Called with the lock held
+        if self.running + self.waiting < self.max_concurrent:
+            return 0.0
+        service_time = self.service_time or 0.0
+        return (self.waiting + 1) * service_time / self.max_concurrent
+
+    def _admit(self, deadline: float = None):
+        if not deadline or not math.isfinite(deadline) or deadline < 0:
+            deadline = self.deadline
+        deadline = min(deadline, self.deadline)
+        with self._lock:
+            estimated = self.estimated_wait()
+            if self.waiting >= self.max_queue:
+                self.rejected += 1
+                raise Rejected(429, "Too many queued requests", estimated)
+            if estimated > deadline:
+                self.rejected += 1
+                raise Rejected(429, "Estimated wait exceeds the request deadline", estimated)
+            self.waiting += 1
+        now = time.monotonic()
+        return {"queued_at": now, "deadline_at": now + deadline}
+
+    def _started(self, ticket, acquired: bool):
+        now = time.monotonic()
+        waited = now - ticket["queued_at"]
+        with self._lock:
+            self.waiting -= 1
+            if not acquired:
+                self.timed_out += 1
+                raise Rejected(503, "Request deadline passed while queued", self.estimated_wait())
+            self.running += 1
+            self.admitted += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+        ticket["started_at"] = now
+        return ticket
+
+    def _abandoned(self):
+        with self._lock:
+            self.waiting -= 1
+
+    def acquire(self, deadline: float = None):
+        # Blocks until a slot is free and returns a ticket for release();
+        # raises Rejected when the request is refused or times out queued
+        ticket = self._admit(deadline)
+        try:
+            acquired = self._slots.acquire(timeout=ticket["deadline_at"] - time.monotonic())
+        except BaseException:
+            self._abandoned()
+            raise
+        return self._started(ticket, acquired)
+
+    async def aacquire(self, deadline: float = None):
+        # Created on first use so it belongs to the running event loop
+        if self._async_slots is None:
+            self._async_slots = asyncio.Semaphore(self.max_concurrent)
+        ticket = self._admit(deadline)
+        try:
+            await asyncio.wait_for(self._async_slots.acquire(), ticket["deadline_at"] - time.monotonic())
+            acquired = time.monotonic() < ticket["deadline_at"]
+            if not acquired:
+                # Got the slot with no time left to answer in
+                self._async_slots.release()
+        except asyncio.TimeoutError:
+            acquired = False
+        except BaseException:
+            # Client went away while queued
+            self._abandoned()
+            raise
+        return self._started(ticket, acquired)
+
+    def release(self, ticket):
+        started_at = ticket.pop("started_at", None)
+        if started_at is None:
+            return
+        if self._async_slots is not None:
+            self._async_slots.release()
+        else:
+            self._slots.release()
+        elapsed = time.monotonic() - started_at
+        with self._lock:
+            self.running -= 1
+            if self.service_time is None:
+                self.service_time = elapsed
+            else:
+                self.service_time += self.smoothing * (elapsed - self.service_time)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "queue_depth": self.waiting,
+                "running": self.running,
+                "max_concurrent": self.max_concurrent,
+                "max_queue": self.max_queue,
+                "admitted": self.admitted,
+                "rejected": self.rejected,
+                "timed_out": self.timed_out,
+                "avg_wait_time": self.wait_time / self.admitted if self.admitted else 0.0,
+                "max_wait_time": self.max_wait_time,
+                "estimated_wait": self.estimated_wait(),
+                "avg_service_time": self.service_time,
+            }
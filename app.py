@@ -1,16 +1,135 @@
 
 ###### test
 
-from flask import Flask, request, jsonify, send_from_directory
+from flask import Flask, Response, request, jsonify, send_from_directory, stream_with_context
+import functools
+import json
+import math
 import os
+import uuid
 from rag import ChatAI
+from jobs import IngestJobs
+from admission import AdmissionController, Rejected
+from watcher import start_in_one_process
+from metrics import REGISTRY, CONTENT_TYPE
+from tracing import new_request_id
+from profiling import Profiler
+
+try:
+    from uwsgidecorators import postfork
+except ImportError:
+    postfork = None
 
 
 app = Flask(__name__)
-assistant = ChatAI()
 
 DOCUMENTS_FOLDER = 'C:\\Users\\Administrator\\Downloads\\all_documents'
 TEMPLATES_FOLDER = 'templates'
+INDEX_FOLDER = 'index'
+JOBS_FOLDER = 'jobs'
+# Each worker writes its metrics here every METRICS_INTERVAL seconds, and
+# /metrics on any worker reports the sum over all of them
+METRICS_FOLDER = 'metrics'
+METRICS_INTERVAL = 10
+# Per-request traces (stage timings, retrieved chunk ids, token counts) are
+# appended to TRACE_FILE as JSON lines; requests taking SLOW_REQUEST_SECONDS
+# or more are also printed with their full breakdown
+TRACE_FILE = os.path.join('traces', 'requests.jsonl')
+SLOW_REQUEST_SECONDS = 10
+# Debug-only CPU profiling: with PROFILE_TOKEN set, an /ask, /ingest or PUT
+# /documents request sent with "X-Profile: <token>" is profiled into
+# PROFILE_FOLDER as <request_id>.prof (per document for ingestion)
+PROFILE_FOLDER = 'profiles'
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN')
+INGEST_WORKERS = 1
+BULK_INGEST_WORKERS = None
+HISTORY_TURNS = 5
+SESSION_TTL = 3600
+CONDENSE_MODE = 'auto'
+ANSWER_CACHE_SIZE = 1000
+ANSWER_CACHE_TTL = 3600
+ANSWER_CACHE_MAX_DISTANCE = 0.1
+RETRIEVAL_K = 3
+RETRIEVAL_SCORE_THRESHOLD = 0.5
+ROUTE_THRESHOLD = 0.5
+RETRIEVAL_MODE = 'hybrid'
+# 'chroma', or 'numpy' for the memory-mapped exact-search store
+# (numpy_store.py; see benchmarks/vector_stores.py)
+VECTOR_BACKEND = 'chroma'
+OLLAMA_BASE_URL = os.environ.get('OLLAMA_BASE_URL', 'http://localhost:11434')
+# Concurrent Ollama generations allowed per worker in ASGI mode (asgi.py)
+OLLAMA_CONCURRENCY = 2
+# Admission control for /ask, per worker: questions answered at once, how
+# many may queue behind them, and the longest a client is assumed to wait
+# (seconds, lowered per request with the X-Request-Timeout header). Keep
+# uwsgi's threads above MAX_CONCURRENT_ASKS + ASK_QUEUE_SIZE, or the queue
+# never fills and the rest wait unrefused in the listen backlog.
+MAX_CONCURRENT_ASKS = 1
+ASK_QUEUE_SIZE = 8
+ASK_DEADLINE = 60
+# The same for asgi.py, where a worker keeps many questions open on one
+# event loop and only OLLAMA_CONCURRENCY of them generate at a time
+ASGI_MAX_CONCURRENT_ASKS = 64
+ASGI_ASK_QUEUE_SIZE = 256
+EMBEDDING_MODEL = 'BAAI/bge-small-en-v1.5'
+# In preload mode (set in uwsgi.ini) the uwsgi master loads the embedding
+# model and opens the index before forking, so workers start warm and share
+# the model pages copy-on-write. ONNX Runtime thread pools do not survive a
+# fork, so the shared session runs single-threaded in each worker.
+PRELOAD_MODELS = os.environ.get('PRELOAD_MODELS') == '1'
+EMBEDDING_THREADS = 1 if PRELOAD_MODELS else None
+EMBEDDING_CACHE_FOLDER = None
+# Index PDFs as they appear in, change in or leave DOCUMENTS_FOLDER; one
+# worker runs the watcher (or run watcher.py on its own instead)
+WATCH_DOCUMENTS = os.environ.get('WATCH_DOCUMENTS') == '1'
+
+assistant = ChatAI(
+    persist_directory=INDEX_FOLDER,
+    embedding_model=EMBEDDING_MODEL,
+    embedding_threads=EMBEDDING_THREADS,
+    embedding_cache_dir=EMBEDDING_CACHE_FOLDER,
+    history_turns=HISTORY_TURNS,
+    session_ttl=SESSION_TTL,
+    condense_mode=CONDENSE_MODE,
+    cache_size=ANSWER_CACHE_SIZE,
+    cache_ttl=ANSWER_CACHE_TTL,
+    cache_max_distance=ANSWER_CACHE_MAX_DISTANCE,
+    retrieval_k=RETRIEVAL_K,
+    score_threshold=RETRIEVAL_SCORE_THRESHOLD,
+    route_threshold=ROUTE_THRESHOLD,
+    retrieval_mode=RETRIEVAL_MODE,
+    vector_backend=VECTOR_BACKEND,
+    llm_concurrency=OLLAMA_CONCURRENCY,
+    ollama_base_url=OLLAMA_BASE_URL,
+    trace_path=TRACE_FILE,
+    slow_request_seconds=SLOW_REQUEST_SECONDS,
+)
+profiler = Profiler(PROFILE_FOLDER, PROFILE_TOKEN)
+
+def ingest_document(file_path, profile=False, **options):
+    # Runs on the ingest job thread, so the profile covers loading,
+    # splitting, embedding and indexing of the one document
+    if profile:
+        name = f"{options.get('request_id')}.{os.path.basename(file_path)}"
+        return profiler.call(name, assistant.ingest, file_path, **options)
+    return assistant.ingest(file_path, **options)
+
+ingest_jobs = IngestJobs(ingest_document, JOBS_FOLDER, max_workers=INGEST_WORKERS)
+admission = AdmissionController(max_concurrent=MAX_CONCURRENT_ASKS, max_queue=ASK_QUEUE_SIZE, deadline=ASK_DEADLINE)
+
+REGISTRY.gauge('insightbot_index_documents', 'Documents in the index', fn=lambda: len(assistant.manifest.entries), merge='max')
+REGISTRY.gauge(
+    'insightbot_index_chunks', 'Chunks in the index',
+    fn=lambda: sum(entry['chunk_count'] for entry in list(assistant.manifest.entries.values())), merge='max',
+)
+def register_admission_metrics(controller):
+    REGISTRY.gauge('insightbot_ask_queue_depth', 'Questions waiting for an admission slot', fn=lambda: controller.waiting)
+    REGISTRY.gauge('insightbot_ask_in_flight', 'Questions being answered', fn=lambda: controller.running)
+    REGISTRY.counter('insightbot_ask_rejected_total', 'Questions refused with 429', fn=lambda: controller.rejected)
+    REGISTRY.counter('insightbot_ask_timed_out_total', 'Questions that timed out queued (503)', fn=lambda: controller.timed_out)
+
+register_admission_metrics(admission)
+REGISTRY.gauge('insightbot_ingest_jobs_pending', 'Ingest jobs queued or running', fn=lambda: ingest_jobs.pending)
 
 # Ensure documents folder exists
 if not os.path.exists(DOCUMENTS_FOLDER):
@@ -18,26 +137,160 @@ if not os.path.exists(DOCUMENTS_FOLDER):
 
 @app.route('/ingest', methods=['POST'])
 def ingest():
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
     files = request.files.getlist('files')
+    file_paths = []
     for file in files:
         filename = file.filename
         file_path = os.path.join(DOCUMENTS_FOLDER, filename)
-        file.save(file_path)
+        save_upload(file, file_path)
         if os.path.exists(file_path):
-            print(f"Ingesting file from path: {file_path}")
-            assistant.ingest(file_path)
+            print(f"Queueing file for ingestion: {file_path}")
+            file_paths.append(file_path)
         else:
             print(f"File path does not exist: {file_path}")
-    return jsonify({"status": "success"})
+    job_id = ingest_jobs.submit(
+        file_paths, tags=parse_tags(request.form.get('tags')), request_id=request_id,
+        profile=profiler.requested(request.headers),
+    )
+    return jsonify({"status": "queued", "job_id": job_id}), 202, {'X-Request-ID': request_id}
+
+def parse_tags(value):
+    # Comma-separated tags from the upload form, or None to keep the
+    # documents' current tags
+    if value is None:
+        return None
+    return [tag.strip() for tag in value.split(',') if tag.strip()]
+
+def save_upload(file, file_path):
+    # Written under a temporary name first, so a folder scan never sees a
+    # partly written PDF
+    tmp_path = f"{file_path}.upload"
+    file.save(tmp_path)
+    os.replace(tmp_path, file_path)
+
+@app.route('/documents', methods=['GET'])
+def list_documents():
+    documents = [{"document_id": document_id, **entry} for document_id, entry in sorted(assistant.documents().items())]
+    return jsonify({"documents": documents})
+
+@app.route('/documents/<document_id>', methods=['PUT'])
+def replace_document(document_id):
+    # Re-ingests the document from the uploaded file; only its own chunks
+    # are replaced, and questions keep being answered meanwhile
+    document_id = os.path.basename(document_id)
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
+    file = request.files.get('file')
+    if file is None:
+        return jsonify({"error": "No file uploaded"}), 400
+    file_path = os.path.join(DOCUMENTS_FOLDER, document_id)
+    save_upload(file, file_path)
+    print(f"Queueing replacement of {document_id}")
+    job_id = ingest_jobs.submit(
+        [file_path], tags=parse_tags(request.form.get('tags')), request_id=request_id,
+        profile=profiler.requested(request.headers),
+    )
+    return jsonify({"status": "queued", "job_id": job_id, "document_id": document_id}), 202, {'X-Request-ID': request_id}
+
+@app.route('/documents/<document_id>', methods=['DELETE'])
+def delete_document(document_id):
+    document_id = os.path.basename(document_id)
+    file_path = os.path.join(DOCUMENTS_FOLDER, document_id)
+    # The file goes first so a startup sync cannot ingest it again
+    removed = os.path.exists(file_path)
+    if removed:
+        os.remove(file_path)
+    removed = assistant.delete_document(document_id) or removed
+    if not removed:
+        return jsonify({"error": "Unknown document id"}), 404
+    return jsonify({"status": "deleted", "document_id": document_id})
+
+@app.route('/ingest/<job_id>', methods=['GET'])
+def ingest_status(job_id):
+    job = ingest_jobs.status(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown job id"}), 404
+    return jsonify(job)
 
 @app.route('/ask', methods=['POST'])
 def ask():
     query = request.json.get('query')
+    # Optional filters: lists of document file names and/or tags
+    try:
+        filters = parse_filters(request.json)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+    # Conversation history is kept per session; the id comes from the
+    # request body or a cookie, and a new one is issued if neither is set
+    session_id = request.json.get('session_id') or request.cookies.get('session_id') or uuid.uuid4().hex
+    # Taken from the X-Request-ID header if set, and echoed back; it names
+    # the question's trace
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
     # Re-initialize the assistant here if necessary
+    assistant.refresh_index()
     if not assistant.chain:
         initialize_assistant()
-    response = assistant.ask(query)
-    return jsonify({"response": response})
+    try:
+        ticket = admission.acquire(request_deadline(request.headers))
+    except Rejected as e:
+        return rejected_response(e)
+    profile = profiler.requested(request.headers)
+    if request.json.get('stream'):
+        events = assistant.ask_stream(query, session_id=session_id, request_id=request_id, **filters)
+        response = stream_response(profiler.iterate(request_id, events) if profile else events)
+        # The slot is held until the last token has been sent
+        response.call_on_close(lambda: admission.release(ticket))
+    else:
+        try:
+            ask = functools.partial(assistant.ask, query, session_id=session_id, request_id=request_id, **filters)
+            answer = profiler.call(request_id, ask) if profile else ask()
+            response = jsonify({"response": answer, "session_id": session_id})
+        finally:
+            admission.release(ticket)
+    response.set_cookie('session_id', session_id, max_age=SESSION_TTL, httponly=True, samesite='Lax')
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+def parse_filters(body):
+    # A single name is taken as a list of one; anything other than strings
+    # is refused rather than matching nothing
+    filters = {}
+    for key in ('documents', 'tags'):
+        value = body.get(key)
+        if isinstance(value, str):
+            value = [value]
+        if value is not None and not (isinstance(value, list) and all(isinstance(item, str) for item in value)):
+            raise ValueError(f"'{key}' must be a list of strings")
+        filters[key] = value
+    return filters
+
+def request_deadline(headers):
+    # X-Request-Timeout in seconds; anything but a positive, finite number
+    # (float() also accepts "nan" and "inf") leaves the default deadline
+    try:
+        deadline = float(headers.get('X-Request-Timeout'))
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(deadline) or deadline <= 0:
+        return None
+    return deadline
+
+def rejected_response(rejection):
+    response = jsonify({"error": rejection.reason})
+    response.status_code = rejection.status
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+def stream_response(events):
+    # Server-sent events, one JSON payload per event
+    def generate():
+        for event in events:
+            yield f"data: {json.dumps(event)}\n\n"
+    return Response(
+        stream_with_context(generate()),
+        mimetype='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+    )
 
 @app.route('/fetch', methods=['GET'])
 def fetch():
@@ -47,20 +300,59 @@ def fetch():
             documents.append(filename)
     return jsonify({"documents": documents})
 
+@app.route('/ready', methods=['GET'])
+def ready():
+    status = {"ready": assistant.ready, "pid": os.getpid(), "index_version": assistant.index_version}
+    return jsonify(status), 200 if assistant.ready else 503
+
+@app.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({"admission": admission.stats(), "cache": assistant.cache.stats()})
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(REGISTRY.render(METRICS_FOLDER), content_type=CONTENT_TYPE)
+
 @app.route('/')
 def index():
     return send_from_directory(TEMPLATES_FOLDER, 'index.html')
 
 def initialize_assistant():
-    # Ingest all existing documents in the DOCUMENTS_FOLDER on startup
+    # Sync the DOCUMENTS_FOLDER into the index; files whose content and
+    # ingest settings match the manifest are skipped by assistant.ingest_many
+    file_paths = []
     for filename in os.listdir(DOCUMENTS_FOLDER):
         if filename.endswith('.pdf'):
             file_path = os.path.join(DOCUMENTS_FOLDER, filename)
             if os.path.exists(file_path):
                 print(f"Loading document on startup from path: {file_path}")
-                assistant.ingest(file_path)
+                file_paths.append(file_path)
             else:
                 print(f"File path does not exist: {file_path}")
+    assistant.ingest_many(file_paths, workers=BULK_INGEST_WORKERS)
+
+
+if PRELOAD_MODELS:
+    # Runs once in the uwsgi master: sync the documents folder before the
+    # workers are forked
+    initialize_assistant()
+assistant.warm_up()
+
+def start_watcher():
+    if WATCH_DOCUMENTS:
+        start_in_one_process(assistant, DOCUMENTS_FOLDER, os.path.join(INDEX_FOLDER, 'watcher.lock'), workers=BULK_INGEST_WORKERS)
+
+if postfork:
+    @postfork
+    def reopen_after_fork():
+        # Counts from the master's startup sync belong to no worker
+        REGISTRY.reset()
+        REGISTRY.start_snapshots(METRICS_FOLDER, METRICS_INTERVAL)
+        assistant.after_fork()
+        start_watcher()
+else:
+    REGISTRY.start_snapshots(METRICS_FOLDER, METRICS_INTERVAL)
+    start_watcher()
 
 
 if __name__ == '__main__':
@@ -0,0 +1,214 @@
+# Async serving mode: the same routes as app.py on Starlette, for example
+#   uvicorn asgi:app --workers 4
+# Each worker handles many open /ask requests on one event loop. Ollama
+# calls are awaited and at most OLLAMA_CONCURRENCY of them run at a time
+# per worker; the rest wait on the semaphore without holding a thread.
+# Admission control has its own, much wider limits than the WSGI app's.
+import asyncio
+import json
+import os
+import time
+import uuid
+from starlette.applications import Starlette
+from starlette.responses import FileResponse, JSONResponse, Response, StreamingResponse
+from starlette.background import BackgroundTask
+from starlette.routing import Route
+from admission import AdmissionController, Rejected
+from metrics import REGISTRY, CONTENT_TYPE
+from tracing import new_request_id
+from app import assistant, ingest_jobs, profiler, initialize_assistant, parse_filters, parse_tags, request_deadline, register_admission_metrics, DOCUMENTS_FOLDER, TEMPLATES_FOLDER, METRICS_FOLDER, SESSION_TTL
+from app import ASGI_MAX_CONCURRENT_ASKS, ASGI_ASK_QUEUE_SIZE, ASK_DEADLINE, OLLAMA_CONCURRENCY
+
+admission = AdmissionController(
+    max_concurrent=max(ASGI_MAX_CONCURRENT_ASKS, OLLAMA_CONCURRENCY),
+    max_queue=ASGI_ASK_QUEUE_SIZE,
+    deadline=ASK_DEADLINE,
+)
+register_admission_metrics(admission)
+
+
+async def ingest(request):
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
+    form = await request.form()
+    file_paths = []
+    for file in form.getlist('files'):
+        file_path = os.path.join(DOCUMENTS_FOLDER, file.filename)
+        await asyncio.to_thread(copy_upload, file.file, file_path)
+        if os.path.exists(file_path):
+            print(f"Queueing file for ingestion: {file_path}")
+            file_paths.append(file_path)
+        else:
+            print(f"File path does not exist: {file_path}")
+    job_id = ingest_jobs.submit(
+        file_paths, tags=parse_tags(form.get('tags')), request_id=request_id,
+        profile=profiler.requested(request.headers),
+    )
+    return JSONResponse({"status": "queued", "job_id": job_id}, status_code=202, headers={'X-Request-ID': request_id})
+
+def copy_upload(source, file_path):
+    # Written under a temporary name first, so a folder scan never sees a
+    # partly written PDF
+    tmp_path = f"{file_path}.upload"
+    with open(tmp_path, 'wb') as f:
+        while True:
+            block = source.read(1024 * 1024)
+            if not block:
+                break
+            f.write(block)
+    os.replace(tmp_path, file_path)
+
+async def list_documents(request):
+    entries = await asyncio.to_thread(assistant.documents)
+    documents = [{"document_id": document_id, **entry} for document_id, entry in sorted(entries.items())]
+    return JSONResponse({"documents": documents})
+
+async def replace_document(request):
+    document_id = os.path.basename(request.path_params['document_id'])
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
+    form = await request.form()
+    file = form.get('file')
+    if file is None or isinstance(file, str):
+        return JSONResponse({"error": "No file uploaded"}, status_code=400)
+    file_path = os.path.join(DOCUMENTS_FOLDER, document_id)
+    await asyncio.to_thread(copy_upload, file.file, file_path)
+    print(f"Queueing replacement of {document_id}")
+    job_id = ingest_jobs.submit(
+        [file_path], tags=parse_tags(form.get('tags')), request_id=request_id,
+        profile=profiler.requested(request.headers),
+    )
+    return JSONResponse(
+        {"status": "queued", "job_id": job_id, "document_id": document_id},
+        status_code=202,
+        headers={'X-Request-ID': request_id},
+    )
+
+async def delete_document(request):
+    document_id = os.path.basename(request.path_params['document_id'])
+    file_path = os.path.join(DOCUMENTS_FOLDER, document_id)
+    # The file goes first so a startup sync cannot ingest it again
+    removed = os.path.exists(file_path)
+    if removed:
+        os.remove(file_path)
+    removed = await asyncio.to_thread(assistant.delete_document, document_id) or removed
+    if not removed:
+        return JSONResponse({"error": "Unknown document id"}, status_code=404)
+    return JSONResponse({"status": "deleted", "document_id": document_id})
+
+async def ingest_status(request):
+    job = ingest_jobs.status(request.path_params['job_id'])
+    if job is None:
+        return JSONResponse({"error": "Unknown job id"}, status_code=404)
+    return JSONResponse(job)
+
+async def ask(request):
+    body = await request.json()
+    query = body.get('query')
+    try:
+        filters = parse_filters(body)
+    except ValueError as e:
+        return JSONResponse({"error": str(e)}, status_code=400)
+    session_id = body.get('session_id') or request.cookies.get('session_id') or uuid.uuid4().hex
+    request_id = new_request_id(request.headers.get('X-Request-ID'))
+    await asyncio.to_thread(assistant.refresh_index)
+    if not assistant.chain:
+        await asyncio.to_thread(initialize_assistant)
+    try:
+        ticket = await admission.aacquire(request_deadline(request.headers))
+    except Rejected as e:
+        return rejected_response(e)
+    if profiler.requested(request.headers):
+        # cProfile follows a single thread, while the async path spreads a
+        # question over the event loop and the thread pool, so a profiled
+        # question runs the blocking code path on one worker thread instead
+        try:
+            if body.get('stream'):
+                events = await asyncio.to_thread(
+                    profiler.call, request_id,
+                    lambda: list(assistant.ask_stream(query, session_id=session_id, request_id=request_id, **filters)),
+                )
+                response = stream_response(replay(events))
+            else:
+                answer = await asyncio.to_thread(
+                    profiler.call, request_id, assistant.ask, query,
+                    session_id=session_id, request_id=request_id, **filters,
+                )
+                response = JSONResponse({"response": answer, "session_id": session_id})
+        finally:
+            admission.release(ticket)
+    elif body.get('stream'):
+        # The slot is held until the last token has been sent
+        response = stream_response(
+            assistant.aask_stream(query, session_id=session_id, request_id=request_id, **filters),
+            background=BackgroundTask(admission.release, ticket),
+        )
+    else:
+        try:
+            # Give up on the answer once the client's deadline has passed
+            answer = await asyncio.wait_for(
+                assistant.aask(query, session_id=session_id, request_id=request_id, **filters),
+                ticket['deadline_at'] - time.monotonic(),
+            )
+        except asyncio.TimeoutError:
+            return rejected_response(Rejected(503, "Request deadline passed", admission.service_time or 0))
+        finally:
+            admission.release(ticket)
+        response = JSONResponse({"response": answer, "session_id": session_id})
+    response.set_cookie('session_id', session_id, max_age=SESSION_TTL, httponly=True, samesite='lax')
+    response.headers['X-Request-ID'] = request_id
+    return response
+
+def rejected_response(rejection):
+    return JSONResponse(
+        {"error": rejection.reason},
+        status_code=rejection.status,
+        headers={'Retry-After': str(rejection.retry_after)},
+    )
+
+async def replay(events):
+    for event in events:
+        yield event
+
+def stream_response(events, background=None):
+    # Server-sent events, one JSON payload per event
+    async def generate():
+        async for event in events:
+            yield f"data: {json.dumps(event)}\n\n"
+    return StreamingResponse(
+        generate(),
+        media_type='text/event-stream',
+        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'},
+        background=background,
+    )
+
+async def fetch(request):
+    documents = [filename for filename in os.listdir(DOCUMENTS_FOLDER) if filename.endswith('.pdf')]
+    return JSONResponse({"documents": documents})
+
+async def ready(request):
+    status = {"ready": assistant.ready, "pid": os.getpid(), "index_version": assistant.index_version}
+    return JSONResponse(status, status_code=200 if assistant.ready else 503)
+
+async def stats(request):
+    return JSONResponse({"admission": admission.stats(), "cache": assistant.cache.stats()})
+
+async def metrics(request):
+    text = await asyncio.to_thread(REGISTRY.render, METRICS_FOLDER)
+    return Response(text, headers={'Content-Type': CONTENT_TYPE})
+
+async def index(request):
+    return FileResponse(os.path.join(TEMPLATES_FOLDER, 'index.html'))
+
+
+app = Starlette(routes=[
+    Route('/ingest', ingest, methods=['POST']),
+    Route('/ingest/{job_id}', ingest_status, methods=['GET']),
+    Route('/documents', list_documents, methods=['GET']),
+    Route('/documents/{document_id}', replace_document, methods=['PUT']),
+    Route('/documents/{document_id}', delete_document, methods=['DELETE']),
+    Route('/ask', ask, methods=['POST']),
+    Route('/fetch', fetch, methods=['GET']),
+    Route('/ready', ready, methods=['GET']),
+    Route('/stats', stats, methods=['GET']),
+    Route('/metrics', metrics, methods=['GET']),
+    Route('/', index),
+])
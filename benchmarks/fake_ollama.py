@@ -0,0 +1,131 @@
+# Local stand-in for the Ollama HTTP API, for load tests without a GPU.
+# Streams NDJSON from /api/chat and /api/generate after a configurable
+# time to first token, at a configurable token rate, and serves at most
+# --parallel generations at once like OLLAMA_NUM_PARALLEL (the rest wait).
+#   python benchmarks/fake_ollama.py --port 11500 --ttft 0.8 --tokens-per-s 30
+# then point the app at it with OLLAMA_BASE_URL=http://localhost:11500
+import argparse
+import json
+import threading
+import time
+from datetime import datetime, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ANSWER_WORDS = (
+    "To fix this, open the settings page, select the device, and restart it. "
+    "If the problem continues, contact the help desk with the error code shown."
+).split()
+
+
+class FakeOllamaHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.rstrip("/") == "/api/tags":
+            self._send_json({"models": [{"name": "mistral:latest"}]})
+        elif self.path.rstrip("/") == "/api/version":
+            self._send_json({"version": "fake"})
+        else:
+            self._send_json({"error": "not found"}, status=404)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.rstrip("/")
+        if path not in ("/api/chat", "/api/generate"):
+            self._send_json({"error": "not found"}, status=404)
+            return
+        chat = path == "/api/chat"
+        model = request.get("model", "mistral")
+        stream = request.get("stream", True)
+        # Words stand in for prompt tokens
+        if chat:
+            prompt = " ".join(message.get("content", "") for message in request.get("messages", []))
+        else:
+            prompt = request.get("prompt", "")
+        prompt_tokens = len(prompt.split())
+
+        queued_at = time.monotonic()
+        with self.server.slots:
+            waited = time.monotonic() - queued_at
+            time.sleep(self.server.ttft)
+            tokens = [ANSWER_WORDS[i % len(ANSWER_WORDS)] + " " for i in range(self.server.tokens)]
+            if not stream:
+                time.sleep(len(tokens) / self.server.tokens_per_s)
+                self._send_json(self._final(model, chat, "".join(tokens), prompt_tokens, len(tokens), waited))
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "application/x-ndjson")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+            for token in tokens:
+                self._send_chunk(self._message(model, chat, token, done=False))
+                time.sleep(1.0 / self.server.tokens_per_s)
+            self._send_chunk(self._final(model, chat, "", prompt_tokens, len(tokens), waited))
+            self.wfile.write(b"0\r\n\r\n")
+
+    def _message(self, model, chat, text, done):
+        message = {"model": model, "created_at": datetime.now(timezone.utc).isoformat(), "done": done}
+        if chat:
+            message["message"] = {"role": "assistant", "content": text}
+        else:
+            message["response"] = text
+        return message
+
+    def _final(self, model, chat, text, prompt_tokens, token_count, waited):
+        message = self._message(model, chat, text, done=True)
+        message.update({
+            "prompt_eval_count": prompt_tokens,
+            "eval_count": token_count,
+            "eval_duration": int(token_count / self.server.tokens_per_s * 1e9),
+            "load_duration": int(waited * 1e9),
+        })
+        return message
+
+    def _send_chunk(self, payload):
+        data = (json.dumps(payload) + "\n").encode()
+        self.wfile.write(b"%x\r\n" % len(data) + data + b"\r\n")
+        self.wfile.flush()
+
+    def _send_json(self, payload, status=200):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+def make_server(host: str = "127.0.0.1", port: int = 11500, ttft: float = 0.5, tokens_per_s: float = 30.0,
+                tokens: int = 40, parallel: int = 1):
+    server = ThreadingHTTPServer((host, port), FakeOllamaHandler)
+    server.daemon_threads = True
+    server.ttft = ttft
+    server.tokens_per_s = tokens_per_s
+    server.tokens = tokens
+    server.slots = threading.BoundedSemaphore(parallel)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11500)
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--tokens-per-s", type=float, default=30.0)
+    parser.add_argument("--tokens", type=int, default=40, help="tokens per answer")
+    parser.add_argument("--parallel", type=int, default=1, help="generations served at once")
+    args = parser.parse_args()
+    server = make_server(args.host, args.port, args.ttft, args.tokens_per_s, args.tokens, args.parallel)
+    print(f"Fake Ollama listening on http://{args.host}:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
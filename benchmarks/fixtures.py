@@ -0,0 +1,97 @@
+# Offline stand-ins for the benchmarks: generated PDFs, a deterministic
+# embedder and a canned chat model, so runs need neither the FastEmbed
+# model download nor a running Ollama.
+import hashlib
+import random
+import re
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_community.chat_models.fake import FakeListChatModel
+
+WORDS = (
+    "printer network password reset account policy laptop monitor driver update "
+    "install server backup restore email calendar access badge office travel "
+    "expense invoice payroll leave request approval manager ticket support "
+    "error code device firmware battery screen keyboard wireless vpn security"
+).split()
+
+
+def make_text(rng: random.Random, words: int):
+    tokens = []
+    for i in range(words):
+        if rng.random() < 0.02:
+            tokens.append(f"E-{rng.randint(1000, 9999)}")
+        else:
+            tokens.append(rng.choice(WORDS))
+        if i % 12 == 11:
+            tokens[-1] += "."
+    return " ".join(tokens)
+
+
+def write_pdf(path: str, pages):
+    # Minimal single-font PDF, one text line per 90 characters
+    objects = [b"<< /Type /Catalog /Pages 2 0 R >>", None, b"<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for text in pages:
+        lines = [text[i:i + 90] for i in range(0, len(text), 90)]
+        stream = "\n".join(
+            f"BT /F1 9 Tf 40 {760 - 12 * n} Td ({line.replace(chr(92), '').replace('(', '').replace(')', '')}) Tj ET"
+            for n, line in enumerate(lines[:60])
+        ).encode("latin1", "replace")
+        kids.append(len(objects) + 1)
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 612 792] /Resources << /Font << /F1 3 0 R >> >>"
+            f" /Contents {len(objects) + 2} 0 R >>".encode()
+        )
+        objects.append(b"<< /Length %d >>\nstream\n" % len(stream) + stream + b"\nendstream")
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>".encode()
+    out = b"%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += b"%d 0 obj\n" % number + body + b"\nendobj\n"
+    xref = len(out)
+    out += b"xref\n0 %d\n0000000000 65535 f \n" % (len(objects) + 1)
+    out += b"".join(b"%010d 00000 n \n" % offset for offset in offsets)
+    out += b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (len(objects) + 1, xref)
+    with open(path, "wb") as f:
+        f.write(out)
+
+
+def make_corpus(directory: str, documents: int, pages: int, words_per_page: int = 400, seed: int = 0):
+    rng = random.Random(seed)
+    paths = []
+    for i in range(documents):
+        path = f"{directory}/doc{i:04d}.pdf"
+        write_pdf(path, [make_text(rng, words_per_page) for _ in range(pages)])
+        paths.append(path)
+    return paths
+
+
+def make_questions(count: int, seed: int = 1):
+    rng = random.Random(seed)
+    return [f"how do I {rng.choice(WORDS)} the {rng.choice(WORDS)} {rng.choice(WORDS)}" for _ in range(count)]
+
+
+class HashingEmbeddings(Embeddings):
+    # Bag of hashed words, normalized: same text, same vector, and texts
+    # sharing words land close together
+    def __init__(self, dim: int = 384):
+        self.dim = dim
+
+    def _embed(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        for word in re.findall(r"\w+", text.lower()):
+            vector[int.from_bytes(hashlib.blake2b(word.encode(), digest_size=4).digest(), "little") % self.dim] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def embed_documents(self, texts):
+        return [self._embed(text) for text in texts]
+
+    def embed_query(self, text: str):
+        return self._embed(text)
+
+
+def fake_chat_model(answer: str = "Restart the device and try again."):
+    return FakeListChatModel(responses=[answer])
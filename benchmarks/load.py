@@ -0,0 +1,188 @@
+# HTTP load generator for a running app (python app.py, uwsgi or uvicorn),
+# best run with the LLM pointed at benchmarks/fake_ollama.py. For each
+# concurrency level, that many clients send /ask requests back to back for
+# --duration seconds, with a --ingest-ratio share of /ingest uploads mixed
+# in. Reports throughput, latency percentiles and error rates per level and
+# where throughput stops growing (the knee).
+#   python benchmarks/load.py --url http://localhost:5000 --levels 1,2,4,8,16,32
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+import uuid
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from fixtures import make_questions, make_text, write_pdf
+
+
+def post(url: str, body: bytes, content_type: str, headers=None, timeout: float = 120):
+    request = urllib.request.Request(url, data=body, method="POST", headers={"Content-Type": content_type, **(headers or {})})
+    return urllib.request.urlopen(request, timeout=timeout)
+
+
+def multipart(fields, files):
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, value in fields.items():
+        parts.append(f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode())
+    for name, (filename, data) in files.items():
+        parts.append(
+            f'--{boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+            f"Content-Type: application/pdf\r\n\r\n".encode() + data + b"\r\n"
+        )
+    parts.append(f"--{boundary}--\r\n".encode())
+    return b"".join(parts), f"multipart/form-data; boundary={boundary}"
+
+
+class LoadClient:
+    def __init__(self, url: str, stream: bool, ingest_ratio: float, timeout: float, workdir: str):
+        self.url = url.rstrip("/")
+        self.stream = stream
+        self.ingest_ratio = ingest_ratio
+        self.timeout = timeout
+        self.workdir = workdir
+        self.questions = make_questions(500)
+        self.uploaded = []
+        self._lock = threading.Lock()
+
+    def ask(self, session_id: str, rng: random.Random):
+        body = json.dumps({"query": rng.choice(self.questions), "session_id": session_id, "stream": self.stream}).encode()
+        start = time.perf_counter()
+        first_token = None
+        with post(f"{self.url}/ask", body, "application/json", timeout=self.timeout) as response:
+            if self.stream:
+                for line in response:
+                    if first_token is None and line.startswith(b"data:"):
+                        first_token = time.perf_counter() - start
+            else:
+                response.read()
+            return response.status, time.perf_counter() - start, first_token
+
+    def ingest(self, rng: random.Random):
+        name = f"load-{uuid.uuid4().hex[:12]}.pdf"
+        path = os.path.join(self.workdir, name)
+        write_pdf(path, [make_text(rng, 300) for _ in range(rng.randint(1, 5))])
+        with open(path, "rb") as f:
+            body, content_type = multipart({}, {"files": (name, f.read())})
+        start = time.perf_counter()
+        with post(f"{self.url}/ingest", body, content_type, timeout=self.timeout) as response:
+            response.read()
+            with self._lock:
+                self.uploaded.append(name)
+            return response.status, time.perf_counter() - start, None
+
+    def run_level(self, concurrency: int, duration: float):
+        samples = []
+        deadline = time.monotonic() + duration
+
+        def worker(index: int):
+            rng = random.Random(concurrency * 1000 + index)
+            session_id = uuid.uuid4().hex
+            while time.monotonic() < deadline:
+                kind = "ingest" if rng.random() < self.ingest_ratio else "ask"
+                start = time.perf_counter()
+                try:
+                    status, latency, first_token = self.ingest(rng) if kind == "ingest" else self.ask(session_id, rng)
+                except urllib.error.HTTPError as e:
+                    status, latency, first_token = e.code, time.perf_counter() - start, None
+                except Exception:
+                    status, latency, first_token = None, time.perf_counter() - start, None
+                with self._lock:
+                    samples.append((kind, status, latency, first_token))
+
+        threads = [threading.Thread(target=worker, args=(i,)) for i in range(concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return summarize(samples, time.monotonic() - started)
+
+    def cleanup(self):
+        for name in self.uploaded:
+            request = urllib.request.Request(f"{self.url}/documents/{name}", method="DELETE")
+            try:
+                urllib.request.urlopen(request, timeout=self.timeout).read()
+            except Exception as e:
+                print(f"Could not delete {name}: {e}")
+
+
+def percentiles(values):
+    if not values:
+        return {}
+    values = np.asarray(values) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(values, p)), 1) for p in (50, 95, 99)}
+
+
+def summarize(samples, elapsed: float):
+    summary = {}
+    for kind in ("ask", "ingest"):
+        kind_samples = [sample for sample in samples if sample[0] == kind]
+        if not kind_samples:
+            continue
+        ok = [sample for sample in kind_samples if sample[1] is not None and 200 <= sample[1] < 300]
+        rejected = [sample for sample in kind_samples if sample[1] in (429, 503)]
+        summary[kind] = {
+            "requests": len(kind_samples),
+            "throughput_rps": round(len(ok) / elapsed, 2),
+            "error_rate": round(1 - len(ok) / len(kind_samples), 4),
+            "rejected": len(rejected),
+            "failed": len(kind_samples) - len(ok) - len(rejected),
+            **percentiles([latency for _, _, latency, _ in ok]),
+        }
+        first_tokens = [first_token for _, _, _, first_token in ok if first_token is not None]
+        if first_tokens:
+            summary[kind]["first_token"] = percentiles(first_tokens)
+    return summary
+
+
+def find_knee(levels, results, gain: float = 0.1):
+    # First level whose /ask throughput grew by less than `gain` over the
+    # previous one; beyond it more clients mostly add queueing delay
+    for previous, level in zip(levels, levels[1:]):
+        before = results[str(previous)].get("ask", {}).get("throughput_rps", 0)
+        after = results[str(level)].get("ask", {}).get("throughput_rps", 0)
+        if before and after < before * (1 + gain):
+            return previous
+    return None
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--url", default="http://localhost:5000")
+    parser.add_argument("--levels", default="1,2,4,8,16")
+    parser.add_argument("--duration", type=float, default=30.0, help="seconds per concurrency level")
+    parser.add_argument("--ingest-ratio", type=float, default=0.05)
+    parser.add_argument("--stream", action="store_true", help="use streamed /ask and report time to first token")
+    parser.add_argument("--timeout", type=float, default=120.0)
+    parser.add_argument("--output", default="load-results.json")
+    parser.add_argument("--keep-uploads", action="store_true")
+    args = parser.parse_args()
+
+    levels = [int(level) for level in args.levels.split(",")]
+    results = {}
+    with tempfile.TemporaryDirectory(prefix="load-") as workdir:
+        client = LoadClient(args.url, args.stream, args.ingest_ratio, args.timeout, workdir)
+        try:
+            for concurrency in levels:
+                results[str(concurrency)] = client.run_level(concurrency, args.duration)
+                print(f"concurrency={concurrency} {json.dumps(results[str(concurrency)])}")
+        finally:
+            if not args.keep_uploads:
+                client.cleanup()
+
+    report = {"config": vars(args), "levels": results, "knee": find_knee(levels, results)}
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+    print(f"Knee of the curve at concurrency {report['knee']}" if report["knee"] else "No knee found in the tested levels")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+# Stage-level benchmark of the ingest and question paths, fully offline
+# (see fixtures.py). Writes the results as JSON; with --baseline it also
+# compares against an earlier results file and exits with status 1 if a
+# metric got worse by more than --tolerance.
+#   python benchmarks/pipeline.py --output results.json
+#   python benchmarks/pipeline.py --baseline results.json
+import argparse
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from fixtures import HashingEmbeddings, fake_chat_model, make_corpus, make_questions
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+from manifest import file_sha256
+from rag import ChatAI, iter_chunks, iter_pages
+
+# Metrics where larger is better; the others are latencies
+HIGHER_IS_BETTER = ("pages_per_s", "chunks_per_s", "vectors_per_s")
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(samples, p)), 3) for p in (50, 95, 99)}
+
+
+def bench_parse(paths):
+    start = time.perf_counter()
+    pages = [text for path in paths for text in iter_pages(path)]
+    return pages, {"pages": len(pages), "pages_per_s": round(len(pages) / (time.perf_counter() - start), 1)}
+
+
+def bench_split(pages, chunk_size, chunk_overlap):
+    splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
+    start = time.perf_counter()
+    chunks = [chunk for text in pages for chunk in splitter.split_text(text)]
+    return {"chunks": len(chunks), "chunks_per_s": round(len(chunks) / (time.perf_counter() - start), 1)}
+
+
+def bench_index(assistant, paths):
+    # Chunks are produced up front so only embedding and indexing are timed
+    prepared = []
+    for path in paths:
+        stats = {}
+        prepared.append((path, list(iter_chunks(path, assistant.chunk_size, assistant.chunk_overlap, stats)), stats))
+    vectors = sum(len(chunks) for _, chunks, _ in prepared)
+    start = time.perf_counter()
+    for path, chunks, stats in prepared:
+        assistant._index_chunks(path, file_sha256(path), chunks, stats=stats)
+    return {"vectors": vectors, "vectors_per_s": round(vectors / (time.perf_counter() - start), 1)}
+
+
+def bench_latency(fn, questions):
+    latencies = []
+    for question in questions:
+        start = time.perf_counter()
+        fn(question)
+        latencies.append(time.perf_counter() - start)
+    return percentiles(latencies)
+
+
+def compare(results, baseline, tolerance):
+    # Returns the metrics that regressed, as "stage.metric: old -> new"
+    regressions = []
+    for stage, metrics in results["stages"].items():
+        for name, value in metrics.items():
+            old = baseline.get("stages", {}).get(stage, {}).get(name)
+            if not old or name in ("pages", "chunks", "vectors"):
+                continue
+            change = value / old - 1 if name in HIGHER_IS_BETTER else old / value - 1 if value else 0
+            if change < -tolerance:
+                regressions.append(f"{stage}.{name}: {old} -> {value}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--documents", type=int, default=20)
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--questions", type=int, default=200)
+    parser.add_argument("--backend", choices=["chroma", "numpy"], default="chroma")
+    parser.add_argument("--retrieval-mode", choices=["hybrid", "vector"], default="hybrid")
+    parser.add_argument("--output", default="pipeline-results.json")
+    parser.add_argument("--baseline")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix="pipeline-bench-")
+    try:
+        os.makedirs(os.path.join(directory, "docs"))
+        paths = make_corpus(os.path.join(directory, "docs"), args.documents, args.pages)
+        assistant = ChatAI(
+            persist_directory=os.path.join(directory, "index"),
+            vector_backend=args.backend,
+            retrieval_mode=args.retrieval_mode,
+            cache_size=0,
+            score_threshold=0.0,
+            route_threshold=0.0,
+            model=fake_chat_model(),
+            embeddings=HashingEmbeddings(),
+        )
+        questions = make_questions(args.questions)
+
+        stages = {}
+        pages, stages["parse"] = bench_parse(paths)
+        stages["split"] = bench_split(pages, assistant.chunk_size, assistant.chunk_overlap)
+        stages["embed_index"] = bench_index(assistant, paths)
+        stages["retrieve"] = bench_latency(assistant._retrieve, questions)
+        stages["ask"] = bench_latency(assistant.ask, questions)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    results = {
+        "created_at": time.time(),
+        "python": platform.python_version(),
+        "machine": platform.machine(),
+        "config": vars(args),
+        "stages": stages,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(json.dumps(stages, indent=2))
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            regressions = compare(results, json.load(f), args.tolerance)
+        for regression in regressions:
+            print(f"Regression: {regression}")
+        sys.exit(1 if regressions else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,147 @@
+# Compares the Chroma and NumPy vector stores on synthetic embeddings:
+# insert throughput, query latency with and without a source filter, and
+# the time to reopen the index. No embedding model is loaded; vectors are
+# random unit vectors around a few hundred centroids, roughly like chunk
+# embeddings.
+#   python benchmarks/vector_stores.py --rows 200000
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from chromadb.api.client import SharedSystemClient
+from langchain_community.vectorstores import Chroma
+from numpy_store import NumpyVectorStore
+
+
+def make_vectors(rows: int, dim: int, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    centroids = rng.standard_normal((max(1, rows // 500), dim)).astype(np.float32)
+    vectors = centroids[rng.integers(0, len(centroids), rows)] + 0.3 * rng.standard_normal((rows, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+
+def percentiles(samples):
+    samples = np.asarray(samples) * 1000
+    return {f"p{p}_ms": round(float(np.percentile(samples, p)), 3) for p in (50, 95, 99)}
+
+
+def time_queries(search, queries, **kwargs):
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        search(query, **kwargs)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+
+def time_reopen(open_store, search, query):
+    # Open time is what a restarted worker waits before it can answer; the
+    # first query is reported apart, since Chroma loads its vector index
+    # lazily on it
+    start = time.perf_counter()
+    store = open_store()
+    open_time = time.perf_counter() - start
+    start = time.perf_counter()
+    search(store, query)
+    first_query = time.perf_counter() - start
+    return {"open_s": round(open_time, 3), "first_query_ms": round(first_query * 1000, 3)}
+
+
+def results(insert_time, rows, latencies, filtered, reopen):
+    return {
+        "insert_vectors_per_s": round(rows / insert_time, 1),
+        **percentiles(latencies),
+        "filtered": percentiles(filtered),
+        **reopen,
+    }
+
+
+def bench_chroma(directory, vectors, queries, k, batch_size):
+    store = Chroma(collection_name="bench", persist_directory=directory)
+    collection = store._collection
+    start = time.perf_counter()
+    for offset in range(0, len(vectors), batch_size):
+        batch = vectors[offset:offset + batch_size]
+        collection.add(
+            ids=[f"c{offset + i}" for i in range(len(batch))],
+            embeddings=batch.tolist(),
+            documents=["chunk"] * len(batch),
+            metadatas=[{"source": f"doc{(offset + i) % 100}.pdf"} for i in range(len(batch))],
+        )
+    insert_time = time.perf_counter() - start
+
+    def search(query, where=None):
+        collection.query(query_embeddings=[query.tolist()], n_results=k, where=where)
+
+    latencies = time_queries(search, queries)
+    filtered = time_queries(search, queries, where={"source": "doc7.pdf"})
+
+    def reopen():
+        # Drop the cached client, as ChatAI does, so the index is read back
+        # from disk instead of reused from this process
+        SharedSystemClient._identifer_to_system.pop(store._client._identifier, None)
+        return Chroma(collection_name="bench", persist_directory=directory)
+
+    reopened = time_reopen(
+        reopen, lambda store, query: store._collection.query(query_embeddings=[query.tolist()], n_results=k), queries[0]
+    )
+    return results(insert_time, len(vectors), latencies, filtered, reopened)
+
+
+def bench_numpy(directory, vectors, queries, k, batch_size):
+    store = NumpyVectorStore(directory, embedding_function=None, collection_name="bench")
+    start = time.perf_counter()
+    for offset in range(0, len(vectors), batch_size):
+        batch = vectors[offset:offset + batch_size]
+        store.add_vectors(
+            batch,
+            ["chunk"] * len(batch),
+            [{"source": f"doc{(offset + i) % 100}.pdf"} for i in range(len(batch))],
+            [f"c{offset + i}" for i in range(len(batch))],
+        )
+    insert_time = time.perf_counter() - start
+
+    def search(query, where=None):
+        store.query(query, k, where=where)
+
+    latencies = time_queries(search, queries)
+    filtered = time_queries(search, queries, where={"source": "doc7.pdf"})
+    reopened = time_reopen(
+        lambda: NumpyVectorStore(directory, embedding_function=None, collection_name="bench"),
+        lambda store, query: store.query(query, k),
+        queries[0],
+    )
+    return results(insert_time, len(vectors), latencies, filtered, reopened)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=12)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--skip-chroma", action="store_true")
+    args = parser.parse_args()
+
+    vectors = make_vectors(args.rows, args.dim)
+    queries = make_vectors(args.queries, args.dim, seed=1)
+    results = {"rows": args.rows, "dim": args.dim, "k": args.k}
+    directory = tempfile.mkdtemp(prefix="vector-bench-")
+    try:
+        results["numpy"] = bench_numpy(os.path.join(directory, "numpy"), vectors, queries, args.k, args.batch_size)
+        if not args.skip_chroma:
+            results["chroma"] = bench_chroma(os.path.join(directory, "chroma"), vectors, queries, args.k, args.batch_size)
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
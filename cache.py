@@ -0,0 +1,83 @@
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+
+
+class SemanticCache:
+    # Answers keyed by question embedding. A lookup hits when a cached
+    # question lies within max_distance (cosine distance) of the new one and
+    # the index version is unchanged; any version change empties the cache.
+    def __init__(self, max_entries: int = 1000, ttl: float = 3600, max_distance: float = 0.1):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_distance = max_distance
+        self.version = None
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._next_key = 0
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0
+
+    def lookup(self, embedding, version):
+        with self._lock:
+            self._check_version(version)
+            self._evict_expired()
+            if not self._entries:
+                self.misses += 1
+                return None
+
+            keys = list(self._entries)
+            matrix = np.stack([self._entries[key]["embedding"] for key in keys])
+            distances = 1.0 - matrix @ _normalize(embedding)
+            best = int(np.argmin(distances))
+            if distances[best] > self.max_distance:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(keys[best])
+            self.hits += 1
+            return self._entries[keys[best]]
+
+    def store(self, question: str, embedding, answer: str, sources, version):
+        with self._lock:
+            self._check_version(version)
+            self._entries[self._next_key] = {
+                "question": question,
+                "embedding": _normalize(embedding),
+                "answer": answer,
+                "sources": sources,
+                "created_at": time.time(),
+            }
+            self._next_key += 1
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
+
+    def _check_version(self, version):
+        if version != self.version:
+            self._entries.clear()
+            self.version = version
+
+    def _evict_expired(self):
+        cutoff = time.time() - self.ttl
+        expired = [key for key, entry in self._entries.items() if entry["created_at"] < cutoff]
+        for key in expired:
+            del self._entries[key]
+
+
+def _normalize(embedding):
+    vector = np.asarray(embedding, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
@@ -0,0 +1,40 @@
+import threading
+from langchain_core.embeddings import Embeddings
+from langchain_community.embeddings import FastEmbedEmbeddings
+
+DEFAULT_EMBEDDING_MODEL = "BAAI/bge-small-en-v1.5"
+
+
+class EmbeddingService(Embeddings):
+    # Loads the ONNX model and tokenizer once and serves both document and
+    # query embeddings from it. Calls are serialized so overlapping uploads
+    # reuse the same session instead of each holding their own buffers.
+    def __init__(self, model_name: str = DEFAULT_EMBEDDING_MODEL, threads: int = None, cache_dir: str = None):
+        self.model_name = model_name
+        self.threads = threads
+        self.cache_dir = cache_dir
+        self._lock = threading.Lock()
+        self._model = FastEmbedEmbeddings(
+            model_name=model_name, threads=threads, cache_dir=cache_dir
+        )
+
+    def embed_documents(self, texts):
+        with self._lock:
+            return self._model.embed_documents(texts)
+
+    def embed_query(self, text: str):
+        with self._lock:
+            return self._model.embed_query(text)
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_embedding_service(model_name: str = DEFAULT_EMBEDDING_MODEL, threads: int = None, cache_dir: str = None):
+    key = (model_name, threads, cache_dir)
+    with _services_lock:
+        if key not in _services:
+            print(f"Loading embedding model {model_name}")
+            _services[key] = EmbeddingService(model_name, threads=threads, cache_dir=cache_dir)
+        return _services[key]
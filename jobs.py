@@ -0,0 +1,94 @@
+import json
+import os
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+
+class IngestJobs:
+    # Runs ingestion on a background thread pool so uploads return at once.
+    # Job state is written to jobs_directory as JSON, which lets any uwsgi
+    # worker answer a status request, not only the one running the job.
+    def __init__(self, ingest_fn, jobs_directory: str, max_workers: int = 1):
+        self.ingest_fn = ingest_fn
+        self.jobs_directory = jobs_directory
+        self._lock = threading.Lock()
+        # Jobs submitted to this process and not finished yet
+        self.pending = 0
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="ingest")
+        os.makedirs(jobs_directory, exist_ok=True)
+
+    def submit(self, file_paths, **options):
+        # options are passed on to ingest_fn for every file
+        job_id = uuid.uuid4().hex
+        job = {
+            "job_id": job_id,
+            "status": "queued",
+            "created_at": time.time(),
+            "started_at": None,
+            "finished_at": None,
+            "options": options,
+            "files": [
+                {"file": os.path.basename(path), "status": "queued", "pages": 0, "chunks": 0, "error": None}
+                for path in file_paths
+            ],
+        }
+        self._save(job)
+        with self._lock:
+            self.pending += 1
+        self._executor.submit(self._run, job, list(file_paths), options)
+        return job_id
+
+    def status(self, job_id: str):
+        path = self._job_path(job_id)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _run(self, job, file_paths, options):
+        try:
+            self._run_files(job, file_paths, options)
+        finally:
+            with self._lock:
+                self.pending -= 1
+
+    def _run_files(self, job, file_paths, options):
+        job["status"] = "running"
+        job["started_at"] = time.time()
+        self._save(job)
+        for entry, path in zip(job["files"], file_paths):
+            entry["status"] = "running"
+            self._save(job)
+            try:
+                self.ingest_fn(path, progress=self._progress(job, entry), **options)
+                if entry["status"] == "running":
+                    entry["status"] = "done"
+            except Exception as e:
+                entry["status"] = "failed"
+                entry["error"] = str(e)
+            self._save(job)
+        failed = any(entry["status"] == "failed" for entry in job["files"])
+        job["status"] = "failed" if failed else "done"
+        job["finished_at"] = time.time()
+        self._save(job)
+
+    def _progress(self, job, entry):
+        def report(**fields):
+            entry.update(fields)
+            if fields.get("error"):
+                entry["status"] = "failed"
+            self._save(job)
+        return report
+
+    def _job_path(self, job_id: str):
+        return os.path.join(self.jobs_directory, f"{os.path.basename(job_id)}.json")
+
+    def _save(self, job):
+        with self._lock:
+            path = self._job_path(job["job_id"])
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job, f)
+            os.replace(tmp_path, path)
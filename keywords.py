@@ -0,0 +1,118 @@
+import os
+import re
+import sqlite3
+from contextlib import contextmanager
+
+
+# Hyphens and underscores are kept inside tokens so part numbers, error
+# codes and SKUs such as "E-4021" or "AB_1200" are indexed as one term
+TOKEN_PATTERN = re.compile(r"[\w][\w\-]*")
+CODE_PATTERN = re.compile(r"^(?=.*\d)(?=.*[a-z\-_])|^\d{4,}$")
+STOP_WORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "can", "do", "does", "for",
+    "from", "how", "i", "in", "is", "it", "my", "of", "on", "or", "the", "to",
+    "what", "when", "where", "which", "who", "why", "with", "you",
+}
+
+
+def query_terms(text: str):
+    terms = [term.strip("-") for term in TOKEN_PATTERN.findall(text.lower())]
+    return [term for term in terms if term and term not in STOP_WORDS]
+
+
+def code_terms(text: str):
+    # Terms that look like identifiers rather than words: letters mixed
+    # with digits, or long digit runs
+    return [term for term in query_terms(text) if CODE_PATTERN.match(term)]
+
+
+def is_code_lookup(text: str, max_terms: int = 3):
+    # A short query made of codes, like "E-4021" or "error 0x80070005"
+    terms = query_terms(text)
+    return 0 < len(terms) <= max_terms and bool(code_terms(text))
+
+
+class KeywordIndex:
+    # BM25 inverted index over the same chunks as the vector store, using
+    # SQLite FTS5 in a file next to the Chroma index so every worker reads
+    # the same data. Rows are keyed by chunk id and written under the index
+    # write lock together with the vectors. FTS5 cannot index the id
+    # column, so chunk_rows maps each chunk id to its FTS rowid and updates
+    # and deletes go through the rowid instead of scanning the table.
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5("
+                " id UNINDEXED, source UNINDEXED, text,"
+                " tokenize=\"unicode61 tokenchars '-_'\")"
+            )
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS chunk_rows (id TEXT PRIMARY KEY, fts_rowid INTEGER NOT NULL)"
+            )
+            # Indexes written before chunk_rows existed get it filled once
+            if conn.execute("SELECT NOT EXISTS (SELECT 1 FROM chunk_rows)").fetchone()[0]:
+                conn.execute("INSERT OR REPLACE INTO chunk_rows (id, fts_rowid) SELECT id, rowid FROM chunks")
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call is safe across threads and forks
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def count(self):
+        with self._connect() as conn:
+            return conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _delete_rows(self, conn, ids):
+        for chunk_id in ids:
+            row = conn.execute("SELECT fts_rowid FROM chunk_rows WHERE id = ?", (chunk_id,)).fetchone()
+            if row is not None:
+                conn.execute("DELETE FROM chunks WHERE rowid = ?", row)
+                conn.execute("DELETE FROM chunk_rows WHERE id = ?", (chunk_id,))
+
+    def add(self, ids, texts, sources):
+        ids = list(ids)
+        with self._connect() as conn:
+            # Re-adding an id replaces the earlier row
+            self._delete_rows(conn, ids)
+            for chunk_id, source, text in zip(ids, sources, texts):
+                cursor = conn.execute("INSERT INTO chunks (id, source, text) VALUES (?, ?, ?)", (chunk_id, source, text))
+                conn.execute("INSERT INTO chunk_rows (id, fts_rowid) VALUES (?, ?)", (chunk_id, cursor.lastrowid))
+
+    def delete(self, ids):
+        with self._connect() as conn:
+            self._delete_rows(conn, ids)
+
+    def clear(self):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM chunks")
+            conn.execute("DELETE FROM chunk_rows")
+
+    def search(self, text: str, k: int, match_all: bool = False, sources=None):
+        # Returns (id, text, source, score) rows, best first; the score is
+        # the BM25 rank with the sign flipped so higher is better. sources,
+        # if given, limits the search to those documents.
+        terms = code_terms(text) if match_all else query_terms(text)
+        if not terms or (sources is not None and not sources):
+            return []
+        operator = " AND " if match_all else " OR "
+        query = operator.join('"' + term.replace('"', '""') + '"' for term in terms)
+        params = [query]
+        source_clause = ""
+        if sources is not None:
+            source_clause = f" AND source IN ({', '.join('?' for _ in sources)})"
+            params.extend(sources)
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT id, text, source, -bm25(chunks) FROM chunks WHERE chunks MATCH ?"
+                f"{source_clause} ORDER BY bm25(chunks) LIMIT ?",
+                (*params, k),
+            ).fetchall()
+        return rows
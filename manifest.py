@@ -0,0 +1,76 @@
+import hashlib
+import json
+import os
+import threading
+import time
+
+
+def file_sha256(file_path: str):
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def chunk_ids(document_id: str, file_hash: str, count: int, start: int = 0):
+    return [f"{document_id}:{file_hash[:16]}:{i}" for i in range(start, start + count)]
+
+
+class IngestManifest:
+    # One entry per document id recording the content hash and the
+    # settings its chunks were produced with, so unchanged files can be
+    # skipped and changed files only have their own vectors replaced.
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self.entries = self._load()
+
+    def reload(self):
+        with self._lock:
+            self.entries = self._load()
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def _save(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+    def get(self, document_id: str):
+        return self.entries.get(document_id)
+
+    def __contains__(self, document_id: str):
+        return document_id in self.entries
+
+    def is_current(self, document_id: str, file_hash: str, settings: dict):
+        entry = self.entries.get(document_id)
+        if not entry or entry["sha256"] != file_hash:
+            return False
+        return all(entry.get(key) == value for key, value in settings.items())
+
+    def record(self, document_id: str, file_hash: str, settings: dict, chunk_count: int):
+        with self._lock:
+            self.entries[document_id] = {
+                "sha256": file_hash,
+                "chunk_count": chunk_count,
+                "ingested_at": time.time(),
+                **settings,
+            }
+            self._save()
+
+    def remove(self, document_id: str):
+        with self._lock:
+            if self.entries.pop(document_id, None) is not None:
+                self._save()
+
+    def clear(self):
+        with self._lock:
+            self.entries = {}
+            self._save()
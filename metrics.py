@@ -0,0 +1,260 @@
+# In-process metrics, served in the Prometheus text format by /metrics.
+# uwsgi runs several worker processes and a scrape reaches only one of
+# them, so every worker writes a snapshot of its metrics to a shared
+# directory and the one answering the scrape merges the snapshots of all
+# workers that are still writing theirs.
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Seconds, from a keyword lookup up to a slow generation on a busy GPU
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+
+def format_labels(key, extra=()):
+    pairs = list(key) + list(extra)
+    if not pairs:
+        return ""
+    escaped = (value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + "}"
+
+
+def format_value(value):
+    return repr(float(value)) if value % 1 else str(int(value))
+
+
+class Metric:
+    kind = None
+
+    def __init__(self, name: str, help: str, fn=None, merge: str = "sum"):
+        # fn, if given, is called for the current value when a snapshot is
+        # taken. merge says how the workers' values are combined: "sum", or
+        # "max" for values every worker sees the same, like the index size.
+        self.name = name
+        self.help = help
+        self.fn = fn
+        self.merge = merge
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def values(self):
+        if self.fn is not None:
+            return [((), self.fn())]
+        with self._lock:
+            return list(self._values.items())
+
+    def reset(self):
+        with self._lock:
+            self._values = {}
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1, **labels):
+        key = label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    kind = "gauge"
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[label_key(labels)] = value
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        key = label_key(labels)
+        with self._lock:
+            counts = self._values.setdefault(key, {"buckets": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts["buckets"][i] += 1
+            counts["sum"] += value
+            counts["count"] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def values(self):
+        with self._lock:
+            return [(key, dict(counts, buckets=list(counts["buckets"]))) for key, counts in self._values.items()]
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self._snapshot_interval = None
+
+    def _register(self, metric):
+        # Registering a name again returns the existing metric, with the new
+        # callback if one is given, so modules can be imported more than once
+        with self._lock:
+            existing = self._metrics.get(metric.name)
+            if existing is None:
+                self._metrics[metric.name] = metric
+                return metric
+            if metric.fn is not None:
+                existing.fn = metric.fn
+            return existing
+
+    def counter(self, name: str, help: str, fn=None):
+        return self._register(Counter(name, help, fn))
+
+    def gauge(self, name: str, help: str, fn=None, merge: str = "sum"):
+        return self._register(Gauge(name, help, fn, merge))
+
+    def histogram(self, name: str, help: str, buckets=DEFAULT_BUCKETS):
+        return self._register(Histogram(name, help, buckets))
+
+    def reset(self):
+        # For a freshly forked worker, so it does not report the parent's
+        # counts as its own
+        for metric in list(self._metrics.values()):
+            metric.reset()
+
+    def snapshot(self):
+        metrics = {}
+        for metric in list(self._metrics.values()):
+            try:
+                values = metric.values()
+            except Exception as e:
+                print(f"Could not read metric {metric.name}: {e}")
+                continue
+            metrics[metric.name] = {
+                "kind": metric.kind,
+                "help": metric.help,
+                "merge": metric.merge,
+                "buckets": list(getattr(metric, "buckets", ())),
+                "values": [[list(map(list, key)), value] for key, value in values],
+            }
+        return {"pid": os.getpid(), "time": time.time(), "metrics": metrics}
+
+    def write_snapshot(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"{os.getpid()}.json")
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(self.snapshot(), f)
+        os.replace(tmp_path, path)
+
+    def start_snapshots(self, directory: str, interval: float = 10.0):
+        # Call once per worker process, after any fork
+        self._snapshot_interval = interval
+
+        def run():
+            while True:
+                try:
+                    self.write_snapshot(directory)
+                except Exception as e:
+                    print(f"Could not write metrics snapshot: {e}")
+                time.sleep(interval)
+
+        threading.Thread(target=run, name="metrics-snapshots", daemon=True).start()
+
+    def read_snapshots(self, directory: str):
+        # This process's snapshot is taken fresh; another worker's counts as
+        # live while it is less than three intervals old, and older ones
+        # (workers that exited) are removed. Counts of an exited worker are
+        # dropped with it, which Prometheus treats as a counter reset.
+        own = self.snapshot()
+        snapshots = [own]
+        if not os.path.isdir(directory):
+            return snapshots
+        max_age = 3 * (self._snapshot_interval or 10.0)
+        for filename in os.listdir(directory):
+            if not filename.endswith(".json") or filename == f"{own['pid']}.json":
+                continue
+            path = os.path.join(directory, filename)
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    snapshot = json.load(f)
+                if own["time"] - snapshot["time"] > max_age:
+                    os.remove(path)
+                    continue
+                snapshots.append(snapshot)
+            except (OSError, ValueError) as e:
+                print(f"Skipping metrics snapshot {filename}: {e}")
+        return snapshots
+
+    def render(self, directory: str = None):
+        snapshots = self.read_snapshots(directory) if directory else [self.snapshot()]
+        return render_snapshots(snapshots)
+
+
+def merge_snapshots(snapshots):
+    merged = {}
+    for snapshot in snapshots:
+        for name, metric in snapshot["metrics"].items():
+            target = merged.setdefault(name, {**metric, "values": {}})
+            for key, value in metric["values"]:
+                key = tuple(map(tuple, key))
+                current = target["values"].get(key)
+                if current is None:
+                    target["values"][key] = value
+                elif metric["kind"] == "histogram":
+                    target["values"][key] = {
+                        "buckets": [a + b for a, b in zip(current["buckets"], value["buckets"])],
+                        "sum": current["sum"] + value["sum"],
+                        "count": current["count"] + value["count"],
+                    }
+                elif metric["merge"] == "max":
+                    target["values"][key] = max(current, value)
+                else:
+                    target["values"][key] = current + value
+    return merged
+
+
+def render_snapshots(snapshots):
+    lines = []
+    for name, metric in sorted(merge_snapshots(snapshots).items()):
+        lines.append(f"# HELP {name} {metric['help']}")
+        lines.append(f"# TYPE {name} {metric['kind']}")
+        for key, value in sorted(metric["values"].items()):
+            if metric["kind"] != "histogram":
+                lines.append(f"{name}{format_labels(key)} {format_value(value)}")
+                continue
+            for bound, count in zip(metric["buckets"], value["buckets"]):
+                lines.append(f"{name}_bucket{format_labels(key, [('le', repr(float(bound)))])} {count}")
+            lines.append(f"{name}_bucket{format_labels(key, [('le', '+Inf')])} {value['count']}")
+            lines.append(f"{name}_sum{format_labels(key)} {format_value(value['sum'])}")
+            lines.append(f"{name}_count{format_labels(key)} {value['count']}")
+    return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# Ingest stages (load, split, embed, index) are observed once per document,
+# question stages (embed_query, retrieve, condense, generate) once per call
+STAGE_SECONDS = REGISTRY.histogram("insightbot_stage_duration_seconds", "Time spent in each pipeline stage")
+QUESTION_SECONDS = REGISTRY.histogram("insightbot_question_duration_seconds", "Time to answer a question")
+FIRST_TOKEN_SECONDS = REGISTRY.histogram("insightbot_first_token_seconds", "Time to the first streamed token")
+DOCUMENTS = REGISTRY.counter("insightbot_documents_total", "Documents processed by ingestion, by result")
+PAGES = REGISTRY.counter("insightbot_pages_loaded_total", "PDF pages loaded")
+CHUNKS = REGISTRY.counter("insightbot_chunks_indexed_total", "Chunks embedded and indexed")
+TOKENS = REGISTRY.counter("insightbot_llm_tokens_total", "Tokens reported by the LLM, by kind")
+CACHE = REGISTRY.counter("insightbot_answer_cache_lookups_total", "Answer cache lookups, by result")
+FALLBACKS = REGISTRY.counter("insightbot_fallbacks_total", "Questions answered without the LLM, by reason")
+ERRORS = REGISTRY.counter("insightbot_errors_total", "Failed operations")
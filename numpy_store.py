@@ -0,0 +1,391 @@
+import json
+import os
+import sqlite3
+import struct
+import threading
+import uuid
+from contextlib import contextmanager
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.vectorstores import VectorStore
+
+
+# The .npy header is always written at this size, so the row count can be
+# rewritten in place when vectors are appended
+HEADER_SIZE = 128
+
+
+def write_header(f, rows: int, dim: int):
+    header = "{'descr': '<f4', 'fortran_order': False, 'shape': (%d, %d), }" % (rows, dim)
+    header = header.ljust(HEADER_SIZE - 11) + "\n"
+    f.seek(0)
+    f.write(b"\x93NUMPY\x01\x00" + struct.pack("<H", len(header)) + header.encode("latin1"))
+
+
+def read_header(f):
+    f.seek(0)
+    np.lib.format.read_magic(f)
+    shape, _, _ = np.lib.format.read_array_header_1_0(f)
+    return shape
+
+
+def metadata_field(key: str):
+    # The JSON path is inlined, not bound, so SQLite can use the expression
+    # index on source
+    path = "$." + json.dumps(key)
+    return "json_extract(metadata, '" + path.replace("'", "''") + "')"
+
+
+def where_clause(where):
+    # Chroma-style metadata filter ({"source": "a.pdf"}, $eq, $ne, $in,
+    # $nin, $and, $or) translated to SQL over the JSON metadata column
+    if not where:
+        return "1", []
+    clauses, params = [], []
+    for key, condition in where.items():
+        if key in ("$and", "$or"):
+            parts = [where_clause(item) for item in condition]
+            joiner = " AND " if key == "$and" else " OR "
+            clauses.append("(" + joiner.join(sql for sql, _ in parts) + ")")
+            params.extend(param for _, part_params in parts for param in part_params)
+            continue
+        field = metadata_field(key)
+        if not isinstance(condition, dict):
+            condition = {"$eq": condition}
+        for operator, value in condition.items():
+            if operator in ("$in", "$nin"):
+                marks = ", ".join("?" for _ in value)
+                negate = "NOT " if operator == "$nin" else ""
+                clauses.append(f"{field} {negate}IN ({marks})")
+                params.extend(value)
+            elif operator in ("$eq", "$ne"):
+                clauses.append(f"{field} {'=' if operator == '$eq' else '!='} ?")
+                params.append(value)
+            else:
+                raise ValueError(f"Unsupported filter operator {operator}")
+    return " AND ".join(clauses), params
+
+
+class NumpyVectorStore(VectorStore):
+    # Exact search over a float32 matrix kept in a memory-mapped .npy file,
+    # so every worker maps the same pages with no copies. Texts, metadata
+    # and deletions live in SQLite next to it. New vectors are appended to
+    # the file and the header's row count is rewritten after them; deleted
+    # rows are only marked and are dropped by compact(), which writes the
+    # live rows to a new file generation.
+    def __init__(self, persist_directory: str, embedding_function, collection_name: str = "documents"):
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        self._embedding_function = embedding_function
+        self.db_path = os.path.join(persist_directory, f"{collection_name}.sqlite3")
+        self._lock = threading.Lock()
+        os.makedirs(persist_directory, exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS rows ("
+                " row INTEGER PRIMARY KEY,"
+                " id TEXT NOT NULL,"
+                " text TEXT NOT NULL,"
+                " metadata TEXT NOT NULL,"
+                " deleted INTEGER NOT NULL DEFAULT 0)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS rows_id ON rows (id)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS rows_source ON rows ({metadata_field('source')})")
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)")
+            conn.execute("INSERT OR IGNORE INTO meta (key, value) VALUES ('generation', '0')")
+        self._load()
+
+    @property
+    def embeddings(self):
+        return self._embedding_function
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call is safe across threads and forks
+        conn = sqlite3.connect(self.db_path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    @contextmanager
+    def _snapshot(self):
+        # A read transaction, so the generation and the rows read with it
+        # come from the same commit even if another process compacts
+        with self._connect() as conn:
+            conn.execute("BEGIN")
+            yield conn
+
+    def _read_generation(self, conn):
+        return int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+
+    def _matrix_path(self, generation: int):
+        return os.path.join(self.persist_directory, f"{self.collection_name}.{generation}.npy")
+
+    def _load(self):
+        # Maps the current file and reads which rows are live. Rows past the
+        # last committed SQLite row (from an interrupted append) stay hidden.
+        with self._connect() as conn:
+            generation = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+            live_rows = np.array([row for row, in conn.execute("SELECT row FROM rows WHERE deleted = 0")], dtype=np.int64)
+        matrix = self._map(generation)
+        live = np.zeros(len(matrix) if matrix is not None else 0, dtype=bool)
+        live[live_rows[live_rows < len(live)]] = True
+        with self._lock:
+            self.generation = generation
+            self._matrix = matrix
+            self._live = live
+            self._norms = self._row_norms(matrix, 0)
+
+    def _map(self, generation: int):
+        path = self._matrix_path(generation)
+        if not os.path.exists(path):
+            return None
+        with open(path, "rb") as f:
+            rows, dim = read_header(f)
+        if not rows:
+            return None
+        return np.memmap(path, dtype="<f4", mode="r", offset=HEADER_SIZE, shape=(rows, dim))
+
+    def _row_norms(self, matrix, start: int):
+        # Squared norms of rows from start on, appended to the known ones
+        if matrix is None:
+            return np.zeros(0, dtype=np.float32)
+        known = self._norms[:start] if start else np.zeros(0, dtype=np.float32)
+        return np.concatenate([known, np.einsum("ij,ij->i", matrix[start:], matrix[start:])])
+
+    def _live_rows(self, conn, ids):
+        rows = []
+        ids = list(ids)
+        for start in range(0, len(ids), 500):
+            batch = ids[start:start + 500]
+            rows.extend(
+                row for row, in conn.execute(
+                    f"SELECT row FROM rows WHERE deleted = 0 AND id IN ({', '.join('?' for _ in batch)})", batch
+                )
+            )
+        return rows
+
+    def count(self):
+        with self._lock:
+            return int(self._live.sum())
+
+    def add_texts(self, texts, metadatas=None, ids=None, **kwargs):
+        texts = list(texts)
+        if not texts:
+            return []
+        metadatas = metadatas or [{} for _ in texts]
+        ids = ids or [uuid.uuid4().hex for _ in texts]
+        vectors = np.asarray(self._embedding_function.embed_documents(texts), dtype="<f4")
+        self.add_vectors(vectors, texts, metadatas, ids)
+        return ids
+
+    def add_vectors(self, vectors, texts, metadatas, ids):
+        # Callers serialize writes (ChatAI holds the index write lock)
+        path = self._matrix_path(self.generation)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                write_header(f, 0, vectors.shape[1])
+        with open(path, "r+b") as f:
+            rows, dim = read_header(f)
+            if dim != vectors.shape[1]:
+                raise ValueError(f"Vectors have {vectors.shape[1]} dimensions, the index has {dim}")
+            f.seek(HEADER_SIZE + rows * dim * 4)
+            f.write(vectors.tobytes())
+            f.truncate()
+            f.flush()
+            write_header(f, rows + len(vectors), dim)
+        with self._connect() as conn:
+            # Re-adding an id replaces the earlier row
+            replaced = self._live_rows(conn, ids)
+            conn.executemany("UPDATE rows SET deleted = 1 WHERE id = ?", ((chunk_id,) for chunk_id in ids))
+            conn.executemany(
+                "INSERT INTO rows (row, id, text, metadata) VALUES (?, ?, ?, ?)",
+                (
+                    (rows + i, chunk_id, text, json.dumps(metadata or {}))
+                    for i, (chunk_id, text, metadata) in enumerate(zip(ids, texts, metadatas))
+                ),
+            )
+        if len(self._live) != rows:
+            self._load()
+            return
+        # Only the new rows are read, rather than reloading everything
+        matrix = self._map(self.generation)
+        with self._lock:
+            live = np.zeros(len(matrix), dtype=bool)
+            known = min(len(self._live), rows)
+            live[:known] = self._live[:known]
+            live[rows:] = True
+            live[replaced] = False
+            self._norms = self._row_norms(matrix, known)
+            self._matrix = matrix
+            self._live = live
+
+    def delete(self, ids=None, **kwargs):
+        if not ids:
+            return
+        with self._connect() as conn:
+            removed = self._live_rows(conn, ids)
+            conn.executemany("UPDATE rows SET deleted = 1 WHERE id = ?", ((chunk_id,) for chunk_id in ids))
+            dead = conn.execute("SELECT COUNT(*) FROM rows WHERE deleted = 1").fetchone()[0]
+            live = conn.execute("SELECT COUNT(*) FROM rows WHERE deleted = 0").fetchone()[0]
+        with self._lock:
+            self._live = self._live.copy()
+            self._live[[row for row in removed if row < len(self._live)]] = False
+        if dead > max(1000, live):
+            self.compact()
+
+    def compact(self):
+        # Call with the index write lock held. Readers still holding the old
+        # generation notice the change on their next query and remap.
+        with self._connect() as conn:
+            generation = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+            live_rows = [row for row, in conn.execute("SELECT row FROM rows WHERE deleted = 0 ORDER BY row")]
+        old_path = self._matrix_path(generation)
+        new_path = self._matrix_path(generation + 1)
+        with self._lock:
+            matrix = self._matrix
+        dim = matrix.shape[1] if matrix is not None else 0
+        with open(new_path, "wb") as f:
+            write_header(f, len(live_rows), dim)
+            for start in range(0, len(live_rows), 10000):
+                f.write(np.ascontiguousarray(matrix[live_rows[start:start + 10000]], dtype="<f4").tobytes())
+        with self._connect() as conn:
+            conn.execute("DELETE FROM rows WHERE deleted = 1")
+            # Rows only move down, in order, so the renumbering never collides
+            conn.executemany(
+                "UPDATE rows SET row = ? WHERE row = ?", ((new, old) for new, old in enumerate(live_rows) if new != old)
+            )
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (str(generation + 1),))
+        if os.path.exists(old_path):
+            os.remove(old_path)
+        self._load()
+
+    def delete_collection(self):
+        with self._connect() as conn:
+            generation = int(conn.execute("SELECT value FROM meta WHERE key = 'generation'").fetchone()[0])
+            conn.execute("DELETE FROM rows")
+            conn.execute("UPDATE meta SET value = ? WHERE key = 'generation'", (str(generation + 1),))
+        if os.path.exists(self._matrix_path(generation)):
+            os.remove(self._matrix_path(generation))
+        self._load()
+
+    def get(self, ids=None, where=None, limit=None, offset=None, include=("documents", "metadatas")):
+        # Same result layout as Chroma's get()
+        sql, params = where_clause(where)
+        if ids is not None:
+            sql += f" AND id IN ({', '.join('?' for _ in ids)})"
+            params.extend(ids)
+        query = f"SELECT row, id, text, metadata FROM rows WHERE deleted = 0 AND {sql} ORDER BY row"
+        if limit is not None:
+            query += f" LIMIT {int(limit)} OFFSET {int(offset or 0)}"
+        for attempt in range(2):
+            with self._snapshot() as conn:
+                rows = conn.execute(query, params).fetchall()
+                generation = self._read_generation(conn)
+            if "embeddings" not in include:
+                break
+            with self._lock:
+                current, matrix = self.generation, self._matrix
+            mapped = len(matrix) if matrix is not None else 0
+            if generation == current and all(row < mapped for row, _, _, _ in rows):
+                break
+            if attempt:
+                # Still being appended by another process; those rows are
+                # left out until the file and this mapping catch up
+                rows = [entry for entry in rows if entry[0] < mapped] if generation == current else []
+                break
+            # Compacted or grown by another process since this one mapped it
+            self._load()
+        result = {"ids": [chunk_id for _, chunk_id, _, _ in rows]}
+        if "documents" in include:
+            result["documents"] = [text for _, _, text, _ in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(metadata) for _, _, _, metadata in rows]
+        if "embeddings" in include:
+            result["embeddings"] = [np.array(matrix[row]) for row, _, _, _ in rows]
+        return result
+
+    def query(self, embedding, k: int = 4, where=None):
+        # Exact top-k by squared L2 distance, the same measure Chroma uses,
+        # so relevance scores and thresholds carry over unchanged. With a
+        # filter only the matching rows are scored.
+        for _ in range(2):
+            with self._lock:
+                generation, matrix, live, norms = self.generation, self._matrix, self._live, self._norms
+            if matrix is None or not k:
+                return []
+            query = np.asarray(embedding, dtype=np.float32)
+            if where:
+                with self._connect() as conn:
+                    sql, params = where_clause(where)
+                    candidates = np.array(
+                        [row for row, in conn.execute(f"SELECT row FROM rows WHERE deleted = 0 AND {sql}", params)],
+                        dtype=np.int64,
+                    )
+                candidates = candidates[candidates < len(live)]
+            else:
+                candidates = np.flatnonzero(live)
+            if not len(candidates):
+                return []
+            if len(candidates) == len(matrix):
+                distances = norms - 2.0 * (matrix @ query) + query @ query
+            else:
+                distances = norms[candidates] - 2.0 * (matrix[candidates] @ query) + query @ query
+            top = min(k, len(candidates))
+            best = np.argpartition(distances, top - 1)[:top]
+            best = best[np.argsort(distances[best])]
+            rows = candidates[best]
+
+            with self._snapshot() as conn:
+                found = {
+                    row: (chunk_id, text, metadata)
+                    for row, chunk_id, text, metadata in conn.execute(
+                        f"SELECT row, id, text, metadata FROM rows WHERE deleted = 0 AND row IN ({', '.join('?' for _ in rows)})",
+                        [int(row) for row in rows],
+                    )
+                }
+                current = self._read_generation(conn)
+            if current != generation:
+                # Compacted by another process since this one mapped the file
+                self._load()
+                continue
+            results = []
+            for row, distance in zip(rows, distances[best]):
+                if int(row) in found:
+                    chunk_id, text, metadata = found[int(row)]
+                    results.append((chunk_id, Document(page_content=text, metadata=json.loads(metadata)), float(max(distance, 0.0))))
+            return results
+        return []
+
+    def distance(self, vector, embedding):
+        vector = np.asarray(vector, dtype=np.float32)
+        return float(np.sum((vector - np.asarray(embedding, dtype=np.float32)) ** 2))
+
+    def _select_relevance_score_fn(self):
+        return self._euclidean_relevance_score_fn
+
+    def similarity_search_by_vector_with_relevance_scores(self, embedding, k: int = 4, filter=None, **kwargs):
+        return [(doc, distance) for _, doc, distance in self.query(embedding, k, where=filter)]
+
+    def similarity_search_by_vector(self, embedding, k: int = 4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)]
+
+    def similarity_search_with_score(self, query: str, k: int = 4, filter=None, **kwargs):
+        embedding = self._embedding_function.embed_query(query)
+        return self.similarity_search_by_vector_with_relevance_scores(embedding, k, filter)
+
+    def _similarity_search_with_relevance_scores(self, query: str, k: int = 4, **kwargs):
+        relevance = self._select_relevance_score_fn()
+        return [(doc, relevance(distance)) for doc, distance in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search(self, query: str, k: int = 4, filter=None, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, filter)]
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, ids=None, persist_directory: str = "index", **kwargs):
+        store = cls(persist_directory, embedding, **kwargs)
+        store.add_texts(texts, metadatas=metadatas, ids=ids)
+        return store
@@ -0,0 +1,47 @@
+# Opt-in CPU profiling of single requests, for hotspots that only some
+# documents or questions trigger. Off unless the server is started with a
+# token; a request is then profiled when its X-Profile header carries that
+# token. Profiles are cProfile dumps named after the request id, e.g.
+#   python -m pstats profiles/<request_id>.prof
+import cProfile
+import hmac
+import os
+import time
+from contextlib import contextmanager
+
+
+class Profiler:
+    def __init__(self, directory: str, token: str = None):
+        self.directory = directory
+        self.token = token
+
+    def requested(self, headers):
+        value = headers.get("X-Profile")
+        if not self.token or not value:
+            return False
+        return hmac.compare_digest(value.encode(), self.token.encode())
+
+    @contextmanager
+    def profile(self, name: str):
+        # cProfile only follows the thread that enabled it, so the profiled
+        # code must run on one thread from start to end
+        profiler = cProfile.Profile()
+        start_time = time.time()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, f"{name}.prof")
+            profiler.dump_stats(path)
+            print(f"Saved profile to {path}. Time taken: {time.time() - start_time:.2f} seconds")
+
+    def call(self, name: str, fn, *args, **kwargs):
+        with self.profile(name):
+            return fn(*args, **kwargs)
+
+    def iterate(self, name: str, events):
+        # For streamed answers: the profile covers the whole stream
+        with self.profile(name):
+            yield from events
@@ -2,26 +2,257 @@
 
 # measuring time
 
+import asyncio
+import multiprocessing
+import os
+import re
+import sys
 import time
+from contextlib import contextmanager
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from itertools import islice
+import numpy as np
+import pypdf
 from langchain_community.vectorstores import Chroma
 from langchain_community.chat_models import ChatOllama
-from langchain_community.embeddings import FastEmbedEmbeddings
-from langchain_community.document_loaders import PyPDFLoader
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain.prompts import PromptTemplate
 from langchain.chains import ConversationalRetrievalChain
-from langchain_community.embeddings import FastEmbedEmbeddings
+from langchain_core.callbacks import BaseCallbackHandler
+from langchain_core.documents import Document
+from embedding import DEFAULT_EMBEDDING_MODEL, get_embedding_service
+from manifest import IngestManifest, chunk_ids, file_sha256
+from sessions import SessionStore
+from cache import SemanticCache
+from shared_index import IndexVersion
+from keywords import KeywordIndex, is_code_lookup
+from numpy_store import NumpyVectorStore
+from metrics import QUESTION_SECONDS, FIRST_TOKEN_SECONDS, DOCUMENTS, PAGES, CHUNKS, TOKENS, CACHE, FALLBACKS, ERRORS
+from tracing import Tracer, add, annotate, record_span, span
+from chromadb.api.client import SharedSystemClient
+
+def iter_pages(pdf_file_path: str):
+    # Pages are extracted one at a time so only the current page's text is
+    # held in memory, however long the document is
+    with open(pdf_file_path, "rb") as f:
+        reader = pypdf.PdfReader(f)
+        for page in reader.pages:
+            yield page.extract_text()
+
+
+def iter_chunks(pdf_file_path: str, chunk_size: int, chunk_overlap: int, stats: dict):
+    # Yields (text, metadata) with the 1-based page number and the chunk's
+    # character offsets within that page's text. stats collects the page
+    # count and the time spent loading and splitting.
+    text_splitter = RecursiveCharacterTextSplitter(
+        chunk_size=chunk_size, chunk_overlap=chunk_overlap
+    )
+    stats.setdefault("pages", 0)
+    stats.setdefault("load", 0.0)
+    stats.setdefault("split", 0.0)
+    pages = iter_pages(pdf_file_path)
+    while True:
+        start = time.perf_counter()
+        text = next(pages, None)
+        stats["load"] += time.perf_counter() - start
+        if text is None:
+            return
+        stats["pages"] += 1
+        start = time.perf_counter()
+        chunks = text_splitter.split_text(text)
+        stats["split"] += time.perf_counter() - start
+        offset = -1
+        for chunk in chunks:
+            offset = text.find(chunk, offset + 1)
+            yield chunk, {"page": stats["pages"], "start_index": offset, "end_index": offset + len(chunk)}
+
+
+def batched(iterable, size: int):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
+
+
+def format_chat_history(chat_history):
+    # Same layout ConversationalRetrievalChain uses for the condense prompt
+    return "".join(f"\nHuman: {question}\nAssistant: {answer}" for question, answer in chat_history)
+
+
+# Words and phrases that usually point back to an earlier turn
+FOLLOW_UP_WORDS = {
+    "it", "its", "they", "them", "their", "this", "that", "these", "those",
+    "he", "she", "him", "her", "there", "same", "above", "previous", "earlier",
+    "former", "latter", "also", "too", "else", "instead", "again", "more",
+}
+FOLLOW_UP_PREFIXES = ("and ", "but ", "so ", "what about", "how about", "why", "what else")
+
+
+def needs_condensing(question: str, chat_history, min_words: int = 4):
+    # Cheap local check for whether a question depends on the conversation;
+    # standalone questions can go straight to retrieval without an LLM call
+    # to rewrite them
+    if not chat_history:
+        return False
+    text = question.lower().strip()
+    words = re.findall(r"[a-z']+", text)
+    if len(words) < min_words or text.startswith(FOLLOW_UP_PREFIXES):
+        return True
+    return any(word in FOLLOW_UP_WORDS for word in words)
+
+
+def load_and_split(pdf_file_path: str, chunk_size: int, chunk_overlap: int):
+    # Module level so it can run in a process pool worker
+    stats = {}
+    chunks = list(iter_chunks(pdf_file_path, chunk_size, chunk_overlap, stats))
+    print(f"Loaded {stats['pages']} pages from {pdf_file_path}, split into {len(chunks)} chunks")
+    return stats, chunks
+
+
+def python_executable():
+    # Under uwsgi sys.executable is the uwsgi binary (unless uwsgi.ini sets
+    # py-sys-executable), which cannot run pool workers; PYTHON_EXECUTABLE
+    # overrides the interpreter found next to the running one
+    executable = os.environ.get("PYTHON_EXECUTABLE") or sys.executable
+    if executable and os.path.basename(executable).lower().startswith("python"):
+        return executable
+    if os.name == "nt":
+        return os.path.join(sys.exec_prefix, "python.exe")
+    return os.path.join(sys.exec_prefix, "bin", "python3")
+
+
+def pool_context():
+    # ingest_many runs on threaded uwsgi workers and the watcher thread,
+    # where a forked child could inherit a lock another thread holds. Pool
+    # workers come from a fork server that only imports this module (spawn
+    # where there is none), started with a real Python interpreter.
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context("forkserver" if "forkserver" in methods else "spawn")
+    context.set_executable(python_executable())
+    if context.get_start_method() == "forkserver":
+        context.set_forkserver_preload(["rag"])
+    return context
+
+
+@contextmanager
+def main_script_hidden():
+    # New pool workers run the __main__ script again as __mp_main__, and
+    # app.py builds a whole ChatAI at import. The workers only need this
+    # module, so the script's path (and module name, for python -m) is
+    # hidden while they are started.
+    main = sys.modules["__main__"]
+    hidden = {key: main.__dict__[key] for key in ("__file__", "__spec__") if key in main.__dict__}
+    main.__dict__.pop("__file__", None)
+    main.__spec__ = None
+    try:
+        yield
+    finally:
+        main.__dict__.update(hidden)
+
+
+class TokenCounter(BaseCallbackHandler):
+    # Counts the prompt and completion tokens Ollama reports with the last
+    # message of each call, in the metrics and the current trace
+    def on_llm_end(self, response, **kwargs):
+        for generations in response.generations:
+            for generation in generations:
+                info = generation.generation_info or {}
+                TOKENS.inc(info.get("prompt_eval_count", 0), kind="prompt")
+                TOKENS.inc(info.get("eval_count", 0), kind="completion")
+                add("prompt_tokens", info.get("prompt_eval_count", 0))
+                add("completion_tokens", info.get("eval_count", 0))
+
+FALLBACK_ANSWER = "Im forwarding this to help desk"
 
 class ChatAI:
-    def __init__(self):
-        self.chat_history = []
+    def __init__(
+        self,
+        persist_directory: str = "index",
+        collection_name: str = "documents",
+        embedding_model: str = DEFAULT_EMBEDDING_MODEL,
+        embedding_threads: int = None,
+        embedding_cache_dir: str = None,
+        sessions_path: str = None,
+        history_turns: int = 5,
+        session_ttl: float = 3600,
+        condense_mode: str = "auto",
+        cache_size: int = 1000,
+        cache_ttl: float = 3600,
+        cache_max_distance: float = 0.1,
+        retrieval_k: int = 3,
+        score_threshold: float = 0.5,
+        route_threshold: float = 0.5,
+        retrieval_mode: str = "hybrid",
+        vector_backend: str = "chroma",
+        llm_concurrency: int = 2,
+        trace_path: str = None,
+        slow_request_seconds: float = None,
+        ollama_base_url: str = "http://localhost:11434",
+        model=None,
+        embeddings=None,
+    ):
+        # condense_mode: "always" rewrites every follow-up question with the
+        # LLM, "auto" only when needs_condensing() says it depends on the
+        # history, "never" sends questions to retrieval unchanged
+        self.condense_mode = condense_mode
+        # Answers are cached per index_version, which changes on every
+        # write to the index; cache_size=0 turns the cache off
+        self.cache = SemanticCache(cache_size, ttl=cache_ttl, max_distance=cache_max_distance)
+        # The index directory is shared by all worker processes; the stamp
+        # tells a worker when another one has written to it
+        self.index_stamp = IndexVersion(persist_directory)
+        self.index_version = 0
+        # Set by warm_up() once the model and index have served a query
+        self.ready = False
+        # Upper bound on Ollama calls in flight from the async entry points
+        self.llm_concurrency = llm_concurrency
+        self._llm_semaphore = None
+        # Chunks below score_threshold are dropped from the context; if the
+        # best remaining chunk scores below route_threshold the question is
+        # sent to the help desk fallback without calling the LLM
+        self.retrieval_k = retrieval_k
+        self.score_threshold = score_threshold
+        self.route_threshold = route_threshold
+        # retrieval_mode: "hybrid" fuses the vector and BM25 keyword results,
+        # "vector" uses the vector store only. In both, short exact-code
+        # queries are answered from the keyword index without embedding.
+        self.retrieval_mode = retrieval_mode
+        self.rrf_k = 60
+        self.keywords = KeywordIndex(os.path.join(persist_directory, "keywords.sqlite3"))
+        self.sessions = SessionStore(
+            sessions_path or os.path.join(persist_directory, "sessions.sqlite3"),
+            max_turns=history_turns,
+            ttl=session_ttl,
+        )
+        self.embedding_model = embedding_model
+        # model and embeddings, if given, replace the Ollama chat model and
+        # the shared FastEmbed service, e.g. with stand-ins for benchmarks
+        self.embeddings = embeddings or get_embedding_service(
+            embedding_model, threads=embedding_threads, cache_dir=embedding_cache_dir
+        )
+        self.persist_directory = persist_directory
+        self.collection_name = collection_name
+        # vector_backend: "chroma", or "numpy" for NumpyVectorStore, an exact
+        # search over a memory-mapped matrix shared by all workers. Each
+        # backend keeps its own manifest, so switching re-ingests into it.
+        self.vector_backend = vector_backend
+        manifest_name = "manifest.json" if vector_backend == "chroma" else f"manifest.{vector_backend}.json"
+        self.manifest = IngestManifest(os.path.join(persist_directory, manifest_name))
         self.vector_store = None
         self.retriever = None
         self.chain = None
-        self.model = ChatOllama(model="mistral", temperature=0)
-        self.text_splitter = RecursiveCharacterTextSplitter(
-            chunk_size=256, chunk_overlap=50
-        )
+        self.model = model or ChatOllama(model="mistral", temperature=0, base_url=ollama_base_url)
+        # Passed to every LLM call, for the token counters
+        self.callbacks = [TokenCounter()]
+        # Traces of questions and ingested documents are appended to
+        # trace_path; those taking slow_request_seconds or more are printed
+        self.tracer = Tracer(trace_path, slow_request_seconds)
+        self.chunk_size = 256
+        self.chunk_overlap = 50
+        self.embed_batch_size = 64
         self.prompt = PromptTemplate.from_template(
             """
             <s> [INST] You are an assistant for question-answering tasks. Use the following pieces of retrieved context 
@@ -32,81 +263,801 @@ class ChatAI:
             Answer: [/INST]
             """
         )
+        # Opening may create the collection or replay the log into the
+        # on-disk vector index, so it is done under the write lock as well
+        with self.index_stamp.write_lock():
+            self.open_index()
+
+    def open_index(self):
+        # The collection lives on disk, so documents ingested by a previous
+        # run are searchable straight away without re-embedding them.
+        self.index_version = self.index_stamp.read()
+        if self.vector_backend == "numpy":
+            self.vector_store = NumpyVectorStore(self.persist_directory, self.embeddings, self.collection_name)
+        else:
+            self.vector_store = Chroma(
+                collection_name=self.collection_name,
+                embedding_function=self.embeddings,
+                persist_directory=self.persist_directory,
+            )
+        if self._index_count():
+            self._build_chain()
+            if not self.keywords.count():
+                self._rebuild_keywords()
+        print(f"Opened index at {self.persist_directory} with {self._index_count()} chunks")
+
+    def _index_count(self):
+        if isinstance(self.vector_store, NumpyVectorStore):
+            return self.vector_store.count()
+        return self.vector_store._collection.count()
+
+    def _drop_client(self):
+        # Forget Chroma's cached client for this path so a new one loads the
+        # current state from disk; the NumPy store keeps no such cache
+        if isinstance(self.vector_store, Chroma):
+            SharedSystemClient._identifer_to_system.pop(self.vector_store._client._identifier, None)
+
+    def refresh_index(self):
+        # Pick up documents written by other workers. Chroma keeps its vector
+        # index in process memory, so the client is reopened, which replays
+        # the new entries from the shared SQLite log. If a writer holds the
+        # lock the refresh is left for a later request.
+        if self.index_stamp.read() == self.index_version:
+            return
+        with self.index_stamp.write_lock(blocking=False) as locked:
+            if locked:
+                self._reopen_index()
+
+    def warm_up(self):
+        # Run one query embedding and an index lookup so the first real
+        # request does not pay for lazy initialization
+        start_time = time.time()
+        self.refresh_index()
+        embedding = self.embeddings.embed_query("warm up")
+        if self._index_count():
+            self.vector_store.similarity_search_by_vector(embedding, k=1)
+        self.ready = True
+        print(f"Warm-up complete. Time taken: {time.time() - start_time:.2f} seconds")
+
+    def after_fork(self):
+        # SQLite connections must not be shared with the parent process, so
+        # a forked worker drops the inherited Chroma client without closing
+        # it and opens its own. The embedding model stays shared copy-on-write.
+        self.ready = False
+        self._drop_client()
+        with self.index_stamp.write_lock():
+            self.open_index()
+        self.warm_up()
+
+    def _sync_index(self):
+        # Call with the write lock held, before changing the index
+        if self.index_stamp.read() != self.index_version:
+            self._reopen_index()
+        self.manifest.reload()
+
+    def _reopen_index(self):
+        print(f"Index changed by another worker, reopening {self.persist_directory}")
+        # In-flight queries keep using the old store
+        self._drop_client()
+        self.manifest.reload()
+        self.cache.invalidate()
+        self.open_index()
+
+    def _rebuild_keywords(self, batch_size: int = 1000):
+        # Call with the write lock held. Fills the keyword index from the
+        # chunks already in the vector store, for indexes built before it
+        # existed.
+        start_time = time.time()
+        offset = 0
+        while True:
+            batch = self.vector_store.get(include=["documents", "metadatas"], limit=batch_size, offset=offset)
+            if not batch["ids"]:
+                break
+            self.keywords.add(
+                batch["ids"], batch["documents"], [metadata.get("source") for metadata in batch["metadatas"]]
+            )
+            offset += len(batch["ids"])
+        print(f"Built keyword index for {offset} chunks. Time taken: {time.time() - start_time:.2f} seconds")
 
-    def ingest(self, pdf_file_path: str):
-        try:
-            start_time = time.time()
-            docs = PyPDFLoader(file_path=pdf_file_path).load()
-            print(f"Loaded {len(docs)} documents from {pdf_file_path}")
-
-            if not docs:
-                raise ValueError("No documents loaded from the PDF file.")
-
-            chunks = []
-            for doc in docs:
-                text = doc.page_content
-                chunks.extend(self.text_splitter.split_text(text))
+    def _build_chain(self):
+        self.retriever = self.vector_store.as_retriever(
+            search_type="similarity_score_threshold",
+            search_kwargs={"k": self.retrieval_k, "score_threshold": self.score_threshold},
+        )
 
-            print(f"Split into {len(chunks)} chunks")
+        self.chain = ConversationalRetrievalChain.from_llm(
+            llm=self.model,
+            chain_type="stuff",
+            retriever=self.retriever,
+            combine_docs_chain_kwargs={"prompt": self.prompt},
+            return_source_documents=True,
+            return_generated_question=True,
+        )
 
-            if not chunks:
+    def has_document(self, pdf_file_path: str):
+        return os.path.basename(pdf_file_path) in self.manifest
+
+    def _ingest_settings(self):
+        return {
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "embedding_model": self.embedding_model,
+        }
+
+    def _needs_ingest(self, pdf_file_path: str, tags=None):
+        # Returns (file_hash, tags), or None when the document is already
+        # indexed as it is. tags=None keeps the document's current tags.
+        document_id = os.path.basename(pdf_file_path)
+        with span("hash"):
+            file_hash = file_sha256(pdf_file_path)
+        current_tags = (self.manifest.get(document_id) or {}).get("tags", [])
+        tags = current_tags if tags is None else sorted(set(tags))
+        if self.manifest.is_current(document_id, file_hash, self._ingest_settings()):
+            if tags != current_tags:
+                # Tags live in the manifest only, so nothing is re-embedded
+                with self.index_stamp.write_lock():
+                    self._sync_index()
+                    entry = self.manifest.get(document_id)
+                    self.manifest.record(
+                        document_id, file_hash, {**self._ingest_settings(), "tags": tags}, entry["chunk_count"]
+                    )
+                    self._index_changed()
+                print(f"Updated tags of {pdf_file_path} to {tags}")
+                DOCUMENTS.inc(result="retagged")
+                return None
+            print(f"Skipping {pdf_file_path}, already indexed with the same content and settings")
+            DOCUMENTS.inc(result="skipped")
+            return None
+        return file_hash, tags
+
+    def ingest(self, pdf_file_path: str, progress=None, tags=None, request_id: str = None):
+        # progress, if given, is called with keyword updates such as pages=,
+        # chunks=, status= and error= so callers can report on the job.
+        # tags label the document for filtered questions.
+        report = progress or (lambda **fields: None)
+        try:
+            with self.tracer.trace("ingest", request_id, document=os.path.basename(pdf_file_path)):
+                start_time = time.time()
+                pending = self._needs_ingest(pdf_file_path, tags)
+                if pending is None:
+                    report(status="skipped")
+                    return
+                file_hash, _ = pending
+                self._ingest_file(pdf_file_path, file_hash, report, tags, start_time)
+        except Exception as e:
+            print(f"Error during ingestion: {e}")
+            DOCUMENTS.inc(result="failed")
+            ERRORS.inc(operation="ingest")
+            report(error=str(e))
+
+    def _ingest_file(self, pdf_file_path: str, file_hash: str, report, tags=None, start_time: float = None):
+        # Pages are loaded, split, embedded and indexed as a stream of
+        # fixed-size batches, so memory does not grow with the document
+        start_time = start_time or time.time()
+        stats = {}
+        chunks = iter_chunks(pdf_file_path, self.chunk_size, self.chunk_overlap, stats)
+        chunk_count = self._index_chunks(pdf_file_path, file_hash, chunks, report, stats, tags)
+        if chunk_count is None:
+            report(status="skipped")
+            return
+
+        end_time = time.time()
+        print(f"Ingested {stats['pages']} pages, {chunk_count} chunks from {pdf_file_path}. Time taken: {end_time - start_time:.2f} seconds")
+
+    def ingest_many(self, pdf_file_paths, workers: int = None):
+        # Parsing and splitting are CPU bound and run in a process pool; the
+        # chunks are embedded and indexed here, one file at a time, as the
+        # workers finish. Embedding is the slower stage, so only a couple of
+        # files per worker are parsed ahead of it.
+        start_time = time.time()
+        pending = {}
+        for pdf_file_path in pdf_file_paths:
+            try:
+                needed = self._needs_ingest(pdf_file_path)
+            except Exception as e:
+                print(f"Error during ingestion of {pdf_file_path}: {e}")
+                DOCUMENTS.inc(result="failed")
+                ERRORS.inc(operation="ingest")
+                continue
+            if needed is not None:
+                pending[pdf_file_path] = needed
+
+        workers = min(workers or os.cpu_count() or 1, len(pending))
+        if workers <= 1:
+            self._ingest_pending(pending)
+            return
+
+        queued = dict(pending)
+        try:
+            self._ingest_in_pool(queued, workers)
+        except Exception as e:
+            # The pool could not be started or broke down; the files it
+            # did not get to are indexed here instead
+            print(f"Process pool failed ({e}), ingesting {len(queued)} remaining files in this process")
+            self._ingest_pending(queued)
+
+        end_time = time.time()
+        print(f"Bulk ingestion of {len(pending)} files with {workers} workers complete. Time taken: {end_time - start_time:.2f} seconds")
+
+    def _ingest_pending(self, pending):
+        # The files are already hashed, so go straight to indexing
+        for pdf_file_path, (file_hash, _) in pending.items():
+            try:
+                with self.tracer.trace("ingest", document=os.path.basename(pdf_file_path)):
+                    self._ingest_file(pdf_file_path, file_hash, lambda **fields: None)
+            except Exception as e:
+                print(f"Error during ingestion of {pdf_file_path}: {e}")
+                DOCUMENTS.inc(result="failed")
+                ERRORS.inc(operation="ingest")
+
+    def _ingest_in_pool(self, queued, workers: int):
+        # Files are removed from queued as they are handled, so whatever is
+        # left if the pool fails has not been indexed
+        paths = iter(list(queued))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=pool_context()) as pool:
+            futures = {}
+
+            def submit(count):
+                # Workers are started on demand, from submit()
+                with main_script_hidden():
+                    for pdf_file_path in islice(paths, count):
+                        future = pool.submit(load_and_split, pdf_file_path, self.chunk_size, self.chunk_overlap)
+                        futures[future] = pdf_file_path
+
+            submit(2 * workers)
+            while futures:
+                done, _ = wait(futures, return_when=FIRST_COMPLETED)
+                # Refill first, so the pool parses while this batch is embedded
+                submit(len(done))
+                for future in done:
+                    pdf_file_path = futures.pop(future)
+                    try:
+                        stats, chunks = future.result()
+                    except BrokenProcessPool:
+                        raise
+                    except Exception as e:
+                        queued.pop(pdf_file_path)
+                        print(f"Error during ingestion of {pdf_file_path}: {e}")
+                        DOCUMENTS.inc(result="failed")
+                        ERRORS.inc(operation="ingest")
+                        continue
+                    file_hash, _ = queued.pop(pdf_file_path)
+                    try:
+                        with self.tracer.trace("ingest", document=os.path.basename(pdf_file_path)):
+                            self._index_chunks(pdf_file_path, file_hash, chunks, stats=stats, tags=None)
+                    except Exception as e:
+                        print(f"Error during ingestion of {pdf_file_path}: {e}")
+                        DOCUMENTS.inc(result="failed")
+                        ERRORS.inc(operation="ingest")
+
+    def _index_chunks(self, pdf_file_path: str, file_hash: str, chunks, report=None, stats=None, tags=()):
+        # Returns the number of chunks indexed, or None when the same content
+        # was indexed by another job while this one waited for the write
+        # lock (an upload and the folder watcher both see a new file).
+        # tags=None keeps the document's current tags.
+        report = report or (lambda **fields: None)
+        stats = stats if stats is not None else {}
+        document_id = os.path.basename(pdf_file_path)
+        chunk_count = 0
+        with self.index_stamp.write_lock():
+            self._sync_index()
+            entry = self.manifest.get(document_id)
+            current_tags = (entry or {}).get("tags", [])
+            tags = current_tags if tags is None else sorted(set(tags))
+            if self.manifest.is_current(document_id, file_hash, self._ingest_settings()):
+                if tags != current_tags:
+                    self.manifest.record(
+                        document_id, file_hash, {**self._ingest_settings(), "tags": tags}, entry["chunk_count"]
+                    )
+                    self._index_changed()
+                print(f"Skipping {pdf_file_path}, indexed by another job in the meantime")
+                DOCUMENTS.inc(result="skipped")
+                return None
+            try:
+                for batch in batched(chunks, self.embed_batch_size):
+                    ids = chunk_ids(document_id, file_hash, len(batch), start=chunk_count)
+                    texts = [text for text, _ in batch]
+                    start = time.perf_counter()
+                    vectors = self.embeddings.embed_documents(texts)
+                    stats["embed"] = stats.get("embed", 0.0) + time.perf_counter() - start
+                    start = time.perf_counter()
+                    self._add_chunks(
+                        ids, texts, [{"source": document_id, **metadata} for _, metadata in batch], vectors
+                    )
+                    chunk_count += len(batch)
+                    self.keywords.add(ids, texts, [document_id] * len(batch))
+                    stats["index"] = stats.get("index", 0.0) + time.perf_counter() - start
+                    report(pages=stats.get("pages", 0), chunks=chunk_count)
+            except Exception:
+                # Drop the partial upload; the previous version stays indexed
+                if chunk_count:
+                    self.vector_store.delete(ids=chunk_ids(document_id, file_hash, chunk_count))
+                    self.keywords.delete(chunk_ids(document_id, file_hash, chunk_count))
+                raise
+
+            if not stats.get("pages", 1):
+                raise ValueError("No documents loaded from the PDF file.")
+            if not chunk_count:
                 raise ValueError("No chunks created from the document.")
 
-            self.vector_store = Chroma.from_texts(
-                texts=chunks, embedding=FastEmbedEmbeddings()
-            )
-            self.retriever = self.vector_store.as_retriever(
-                search_type="similarity_score_threshold",
-                search_kwargs={"k": 3, "score_threshold": 0.5},
+            self._delete_stale_chunks(document_id, set(chunk_ids(document_id, file_hash, chunk_count)))
+            self.manifest.record(document_id, file_hash, {**self._ingest_settings(), "tags": list(tags)}, chunk_count)
+            self._index_changed()
+        if not self.chain:
+            self._build_chain()
+        # Totals over the document, since loading and splitting run
+        # interleaved with embedding, batch by batch
+        for stage in ("load", "split", "embed", "index"):
+            if stage in stats:
+                record_span(stage, stats[stage])
+        annotate(pages=stats.get("pages", 0), chunks=chunk_count)
+        DOCUMENTS.inc(result="indexed")
+        PAGES.inc(stats.get("pages", 0))
+        CHUNKS.inc(chunk_count)
+        return chunk_count
+
+    def _add_chunks(self, ids, texts, metadatas, vectors):
+        # Chunks are embedded by the caller, so embedding and indexing can
+        # be timed apart
+        if isinstance(self.vector_store, NumpyVectorStore):
+            self.vector_store.add_vectors(np.asarray(vectors, dtype="<f4"), texts, metadatas, ids)
+        else:
+            self.vector_store._collection.upsert(ids=ids, embeddings=vectors, metadatas=metadatas, documents=texts)
+
+    def _index_changed(self):
+        # Call with the write lock held, after changing the index
+        self.index_version = self.index_stamp.bump()
+        self.cache.invalidate()
+
+    def _document_chunk_ids(self, document_id: str):
+        entry = self.manifest.get(document_id)
+        if entry:
+            return chunk_ids(document_id, entry["sha256"], entry["chunk_count"])
+        # Chunks indexed before the manifest existed have random ids
+        return self.vector_store.get(where={"source": document_id}, include=[])["ids"]
+
+    def _delete_stale_chunks(self, document_id: str, keep_ids: set):
+        stale_ids = [chunk_id for chunk_id in self._document_chunk_ids(document_id) if chunk_id not in keep_ids]
+        if stale_ids:
+            self.vector_store.delete(ids=stale_ids)
+            self.keywords.delete(stale_ids)
+
+    def delete_document(self, document_id: str):
+        # Removes one document's chunks and manifest entry, leaving the rest
+        # of the index alone; returns False if the document is not indexed.
+        # Replacing a document is a plain ingest of the new file under the
+        # same name: its new chunks are added before the old ones go.
+        with self.index_stamp.write_lock():
+            self._sync_index()
+            ids = self._document_chunk_ids(document_id)
+            if not ids and document_id not in self.manifest:
+                return False
+            if ids:
+                self.vector_store.delete(ids=ids)
+                self.keywords.delete(ids)
+            self.manifest.remove(document_id)
+            self._index_changed()
+        print(f"Deleted {len(ids)} chunks of {document_id}")
+        return True
+
+    def documents(self):
+        self.refresh_index()
+        return {document_id: dict(entry) for document_id, entry in self.manifest.entries.items()}
+
+    def _condense_question(self, query: str, chat_history):
+        if not chat_history or self.condense_mode == "never":
+            return query
+        if self.condense_mode == "auto" and not needs_condensing(query, chat_history):
+            return query
+        with span("condense"):
+            return self.chain.question_generator.run(
+                question=query, chat_history=format_chat_history(chat_history), callbacks=self.callbacks
             )
 
-            self.chain = ConversationalRetrievalChain.from_llm(
-                llm=self.model,
-                chain_type="stuff",
-                retriever=self.retriever,
-                combine_docs_chain_kwargs={"prompt": self.prompt},
-                return_source_documents=True,
-                return_generated_question=True,
+    def _cache_lookup(self, question: str, sources=None):
+        # Exact-code questions skip the cache so they need no embedding, and
+        # filtered questions skip it so they never get an unfiltered answer
+        if not self.cache.enabled or is_code_lookup(question) or sources is not None:
+            return None, None
+        embedding = self._embed_query(question)
+        cached = self.cache.lookup(embedding, self.index_version)
+        CACHE.inc(result="hit" if cached else "miss")
+        annotate(cached=bool(cached))
+        return cached, embedding
+
+    def _embed_query(self, question: str):
+        with span("embed_query"):
+            return self.embeddings.embed_query(question)
+
+    def _cache_store(self, question: str, embedding, answer: str, context):
+        if embedding is not None:
+            self.cache.store(question, embedding, answer, context, self.index_version)
+
+    def _filter_sources(self, documents=None, tags=None):
+        # Document ids a question is limited to, or None for the whole index
+        if not documents and not tags:
+            return None
+        sources = set(documents) if documents else set(self.manifest.entries)
+        if tags:
+            sources = {
+                document_id for document_id in sources
+                if set(tags) & set((self.manifest.get(document_id) or {}).get("tags", []))
+            }
+        return sorted(sources)
+
+    def _retrieve(self, question: str, embedding=None, sources=None):
+        # sources, if given, limits the search to those document ids
+        if sources is not None and not sources:
+            return []
+        if is_code_lookup(question):
+            with span("keyword_lookup"):
+                context = self._keyword_lookup(question, sources)
+            if context:
+                return context
+        if embedding is None:
+            embedding = self._embed_query(question)
+        with span("retrieve"):
+            if self.retrieval_mode == "hybrid":
+                return self._hybrid_search(question, embedding, sources)
+            return self._vector_search(embedding, self.retrieval_k, sources)
+
+    def _keyword_lookup(self, question: str, sources=None):
+        # Chunks containing every code in the question are taken as exact
+        # matches, without running the embedding model
+        rows = self.keywords.search(question, self.retrieval_k, match_all=True, sources=sources)
+        if not rows:
+            return []
+        annotate(chunk_ids=[chunk_id for chunk_id, _, _, _ in rows])
+        stored = self.vector_store.get(ids=[chunk_id for chunk_id, _, _, _ in rows], include=["metadatas"])
+        metadatas = dict(zip(stored["ids"], stored["metadatas"]))
+        return [
+            Document(
+                page_content=text,
+                metadata={"source": source, **(metadatas.get(chunk_id) or {}), "score": 1.0, "match": "keyword"},
             )
+            for chunk_id, text, source, _ in rows
+        ]
+
+    def _vector_query(self, embedding, k: int, sources=None):
+        # Queries the collection directly, since the LangChain wrapper does
+        # not return chunk ids; yields (id, document) with the relevance
+        # score in the metadata
+        relevance = self.vector_store._select_relevance_score_fn()
+        where = {"source": {"$in": sources}} if sources is not None else None
+        if isinstance(self.vector_store, NumpyVectorStore):
+            for chunk_id, doc, distance in self.vector_store.query(embedding, k, where=where):
+                doc.metadata["score"] = relevance(distance)
+                yield chunk_id, doc
+            return
+        results = self.vector_store._collection.query(
+            query_embeddings=[embedding], n_results=k, where=where, include=["documents", "metadatas", "distances"]
+        )
+        for chunk_id, text, metadata, distance in zip(
+            results["ids"][0], results["documents"][0], results["metadatas"][0], results["distances"][0]
+        ):
+            doc = Document(page_content=text, metadata=dict(metadata or {}))
+            doc.metadata["score"] = relevance(distance)
+            yield chunk_id, doc
+
+    def _vector_search(self, embedding, k: int, sources=None):
+        results = [
+            (chunk_id, doc) for chunk_id, doc in self._vector_query(embedding, k, sources)
+            if doc.metadata["score"] >= self.score_threshold
+        ]
+        annotate(chunk_ids=[chunk_id for chunk_id, _ in results])
+        return [doc for _, doc in results]
+
+    def _hybrid_search(self, question: str, embedding, sources=None):
+        # Reciprocal rank fusion of the vector and BM25 result lists. Keyword
+        # hits the vector search missed still need a relevance score for the
+        # threshold and routing, so theirs is computed from the stored vectors.
+        candidates = self.retrieval_k * 4
+        fused = {}
+        for rank, (chunk_id, doc) in enumerate(self._vector_query(embedding, candidates, sources)):
+            fused[chunk_id] = [doc, 1.0 / (self.rrf_k + rank + 1)]
+
+        missing = {}
+        for rank, (chunk_id, text, source, _) in enumerate(self.keywords.search(question, candidates, sources=sources)):
+            if chunk_id in fused:
+                fused[chunk_id][1] += 1.0 / (self.rrf_k + rank + 1)
+            else:
+                doc = Document(page_content=text, metadata={"source": source})
+                fused[chunk_id] = [doc, 1.0 / (self.rrf_k + rank + 1)]
+                missing[chunk_id] = doc
+        if missing:
+            stored = self.vector_store.get(ids=list(missing), include=["embeddings", "metadatas"])
+            relevance = self.vector_store._select_relevance_score_fn()
+            for chunk_id, vector, metadata in zip(stored["ids"], stored["embeddings"], stored["metadatas"]):
+                missing[chunk_id].metadata.update(metadata or {})
+                missing[chunk_id].metadata["score"] = relevance(self._distance(vector, embedding))
+
+        ranked = sorted(fused.items(), key=lambda item: item[1][1], reverse=True)
+        context = []
+        ids = []
+        for chunk_id, (doc, _) in ranked:
+            if doc.metadata.get("score", 0.0) >= self.score_threshold:
+                context.append(doc)
+                ids.append(chunk_id)
+                if len(context) == self.retrieval_k:
+                    break
+        annotate(chunk_ids=ids)
+        return context
+
+    def _distance(self, vector, embedding):
+        # Same distance the collection's HNSW index uses
+        if isinstance(self.vector_store, NumpyVectorStore):
+            return self.vector_store.distance(vector, embedding)
+        vector = np.asarray(vector, dtype=np.float32)
+        query = np.asarray(embedding, dtype=np.float32)
+        space = (self.vector_store._collection.metadata or {}).get("hnsw:space", "l2")
+        if space == "cosine":
+            return float(1.0 - vector @ query / (np.linalg.norm(vector) * np.linalg.norm(query)))
+        if space == "ip":
+            return float(1.0 - vector @ query)
+        return float(np.sum((vector - query) ** 2))
+
+    def _should_answer(self, context):
+        return bool(context) and max(doc.metadata["score"] for doc in context) >= self.route_threshold
+
+    def _build_prompt(self, question: str, context):
+        return self.prompt.format(
+            question=question, context="\n\n".join(doc.page_content for doc in context)
+        )
 
-            end_time = time.time()
-            print(f"Ingestion complete. Chain setup successful. Time taken: {end_time - start_time:.2f} seconds")
-        except Exception as e:
-            print(f"Error during ingestion: {e}")
+    def _generate(self, question: str, context):
+        with span("generate"):
+            return self.model.invoke(self._build_prompt(question, context), config={"callbacks": self.callbacks}).content
+
+    def _begin_question(self, session_id: str):
+        with span("history"):
+            self.refresh_index()
+            return self.sessions.history(session_id) if session_id else []
+
+    def _lookup(self, question: str, sources=None):
+        cached, embedding = self._cache_lookup(question, sources)
+        context = cached["sources"] if cached else self._retrieve(question, embedding, sources)
+        return cached, embedding, context
 
-    def ask(self, query: str):
+    def ask(self, query: str, session_id: str = None, documents=None, tags=None, request_id: str = None):
+        # documents and tags limit retrieval to those document ids, or to
+        # documents ingested with any of those tags. request_id names the
+        # trace of the question (see tracing.py).
         if not self.chain:
-            print("Chain not initialized.")
+            FALLBACKS.inc(reason="empty_index")
             return "Please, add a PDF document first."
 
         try:
-            start_time = time.time()
-            result = self.chain.invoke({"question": query, "chat_history": self.chat_history})
-            context = result["source_documents"]
-            answer = result["answer"]
+            with self.tracer.trace("ask", request_id, session_id=session_id):
+                start_time = time.time()
+                chat_history = self._begin_question(session_id)
+                sources = self._filter_sources(documents, tags)
+                question = self._condense_question(query, chat_history)
+                cached, embedding = self._cache_lookup(question, sources)
+                if cached:
+                    context = cached["sources"]
+                    answer = cached["answer"]
+                else:
+                    context = self._retrieve(question, embedding, sources)
+                    if self._should_answer(context):
+                        answer = self._generate(question, context)
+                    else:
+                        FALLBACKS.inc(reason="no_context")
+                        answer = FALLBACK_ANSWER
+                    self._cache_store(question, embedding, answer, context)
+
+                if session_id:
+                    self.sessions.append(session_id, query, answer)
+
+                QUESTION_SECONDS.observe(time.time() - start_time)
+                return answer
+        except Exception as e:
+            print(f"Error during ask: {e}")
+            ERRORS.inc(operation="ask")
+            return "An error occurred."
 
-            if not context:
-                answer = "Im forwarding this to help desk"
+    def ask_stream(self, query: str, session_id: str = None, documents=None, tags=None, request_id: str = None):
+        # Yields {"type": "token"} events as the model generates, then one
+        # {"type": "done"} event with the full answer, sources and timings
+        if not self.chain:
+            FALLBACKS.inc(reason="empty_index")
+            yield {"type": "done", "answer": "Please, add a PDF document first.", "sources": [], "timings": {}}
+            return
 
-            self.chat_history.extend([(query, answer)])
+        try:
+            with self.tracer.trace("ask", request_id, session_id=session_id, stream=True):
+                timings = {}
+                start_time = time.time()
+                chat_history = self._begin_question(session_id)
+                sources = self._filter_sources(documents, tags)
+                question = self._condense_question(query, chat_history)
+                timings["condense"] = time.time() - start_time
+
+                cached, embedding = self._cache_lookup(question, sources)
+                if cached:
+                    context = cached["sources"]
+                else:
+                    retrieve_start = time.time()
+                    context = self._retrieve(question, embedding, sources)
+                    timings["retrieve"] = time.time() - retrieve_start
+
+                generate_start = time.time()
+                if cached:
+                    answer = cached["answer"]
+                    yield {"type": "token", "text": answer}
+                elif self._should_answer(context):
+                    tokens = []
+                    with span("generate"):
+                        for chunk in self.model.stream(
+                            self._build_prompt(question, context), config={"callbacks": self.callbacks}
+                        ):
+                            if not tokens:
+                                timings["first_token"] = time.time() - start_time
+                                FIRST_TOKEN_SECONDS.observe(timings["first_token"])
+                            tokens.append(chunk.content)
+                            yield {"type": "token", "text": chunk.content}
+                    answer = "".join(tokens)
+                else:
+                    FALLBACKS.inc(reason="no_context")
+                    answer = FALLBACK_ANSWER
+                    yield {"type": "token", "text": answer}
+                timings["generate"] = time.time() - generate_start
+                if not cached:
+                    self._cache_store(question, embedding, answer, context)
+
+                if session_id:
+                    self.sessions.append(session_id, query, answer)
+
+                timings["total"] = time.time() - start_time
+                QUESTION_SECONDS.observe(timings["total"])
+
+                yield {
+                    "type": "done",
+                    "answer": answer,
+                    "generated_question": question,
+                    "cached": bool(cached),
+                    "sources": [
+                        {"content": doc.page_content, "metadata": doc.metadata} for doc in context
+                    ],
+                    "timings": timings,
+                }
+        except Exception as e:
+            print(f"Error during ask: {e}")
+            ERRORS.inc(operation="ask")
+            yield {"type": "error", "error": "An error occurred."}
+
+    def _llm_slots(self):
+        # Created on first use so it belongs to the running event loop
+        if self._llm_semaphore is None:
+            self._llm_semaphore = asyncio.Semaphore(self.llm_concurrency)
+        return self._llm_semaphore
+
+    async def _acondense_question(self, query: str, chat_history):
+        if not chat_history or self.condense_mode == "never":
+            return query
+        if self.condense_mode == "auto" and not needs_condensing(query, chat_history):
+            return query
+        async with self._llm_slots():
+            with span("condense"):
+                return await self.chain.question_generator.arun(
+                    question=query, chat_history=format_chat_history(chat_history), callbacks=self.callbacks
+                )
+
+    async def aask(self, query: str, session_id: str = None, documents=None, tags=None, request_id: str = None):
+        # Same as ask(), for asyncio servers: Ollama calls are awaited under
+        # the llm_concurrency semaphore and the blocking index and SQLite
+        # work runs on the default thread pool
+        if not self.chain:
+            FALLBACKS.inc(reason="empty_index")
+            return "Please, add a PDF document first."
 
-            end_time = time.time()
-            print(f"Question answered. Time taken: {end_time - start_time:.2f} seconds")
+        try:
+            with self.tracer.trace("ask", request_id, session_id=session_id):
+                start_time = time.time()
+                chat_history = await asyncio.to_thread(self._begin_question, session_id)
+                sources = self._filter_sources(documents, tags)
+                question = await self._acondense_question(query, chat_history)
+                cached, embedding, context = await asyncio.to_thread(self._lookup, question, sources)
+                if cached:
+                    answer = cached["answer"]
+                else:
+                    if self._should_answer(context):
+                        async with self._llm_slots():
+                            with span("generate"):
+                                result = await self.model.ainvoke(
+                                    self._build_prompt(question, context), config={"callbacks": self.callbacks}
+                                )
+                        answer = result.content
+                    else:
+                        FALLBACKS.inc(reason="no_context")
+                        answer = FALLBACK_ANSWER
+                    self._cache_store(question, embedding, answer, context)
+
+                if session_id:
+                    await asyncio.to_thread(self.sessions.append, session_id, query, answer)
+
+                QUESTION_SECONDS.observe(time.time() - start_time)
+                return answer
+        except Exception as e:
+            print(f"Error during ask: {e}")
+            ERRORS.inc(operation="ask")
+            return "An error occurred."
 
-            print(f"\n\nChat History: {self.chat_history}")
-            print(f"\n\nSource Documents: {context}")
-            print(f"\n\nGenerated Question: {result['generated_question']}")
+    async def aask_stream(self, query: str, session_id: str = None, documents=None, tags=None, request_id: str = None):
+        # Async counterpart of ask_stream(), yielding the same events
+        if not self.chain:
+            FALLBACKS.inc(reason="empty_index")
+            yield {"type": "done", "answer": "Please, add a PDF document first.", "sources": [], "timings": {}}
+            return
 
-            return answer
+        try:
+            with self.tracer.trace("ask", request_id, session_id=session_id, stream=True):
+                timings = {}
+                start_time = time.time()
+                chat_history = await asyncio.to_thread(self._begin_question, session_id)
+                sources = self._filter_sources(documents, tags)
+                question = await self._acondense_question(query, chat_history)
+                timings["condense"] = time.time() - start_time
+
+                retrieve_start = time.time()
+                cached, embedding, context = await asyncio.to_thread(self._lookup, question, sources)
+                timings["retrieve"] = time.time() - retrieve_start
+
+                generate_start = time.time()
+                if cached:
+                    answer = cached["answer"]
+                    yield {"type": "token", "text": answer}
+                elif self._should_answer(context):
+                    tokens = []
+                    async with self._llm_slots():
+                        with span("generate"):
+                            async for chunk in self.model.astream(
+                                self._build_prompt(question, context), config={"callbacks": self.callbacks}
+                            ):
+                                if not tokens:
+                                    timings["first_token"] = time.time() - start_time
+                                    FIRST_TOKEN_SECONDS.observe(timings["first_token"])
+                                tokens.append(chunk.content)
+                                yield {"type": "token", "text": chunk.content}
+                    answer = "".join(tokens)
+                else:
+                    FALLBACKS.inc(reason="no_context")
+                    answer = FALLBACK_ANSWER
+                    yield {"type": "token", "text": answer}
+                timings["generate"] = time.time() - generate_start
+                if not cached:
+                    self._cache_store(question, embedding, answer, context)
+
+                if session_id:
+                    await asyncio.to_thread(self.sessions.append, session_id, query, answer)
+
+                timings["total"] = time.time() - start_time
+                QUESTION_SECONDS.observe(timings["total"])
+
+                yield {
+                    "type": "done",
+                    "answer": answer,
+                    "generated_question": question,
+                    "cached": bool(cached),
+                    "sources": [
+                        {"content": doc.page_content, "metadata": doc.metadata} for doc in context
+                    ],
+                    "timings": timings,
+                }
         except Exception as e:
             print(f"Error during ask: {e}")
-            return "An error occurred."
+            ERRORS.inc(operation="ask")
+            yield {"type": "error", "error": "An error occurred."}
 
     def clear(self):
-        self.vector_store = None
-        self.retriever = None
-        self.chain = None
-        self.chat_history = []
+        with self.index_stamp.write_lock():
+            self.vector_store.delete_collection()
+            self.keywords.clear()
+            self.manifest.clear()
+            self._index_changed()
+            self.retriever = None
+            self.chain = None
+            self.sessions.clear()
+            self.open_index()
 
 
 
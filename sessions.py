@@ -0,0 +1,71 @@
+import os
+import sqlite3
+import time
+from contextlib import contextmanager
+
+
+class SessionStore:
+    # Conversation turns keyed by session id in a local SQLite file, so all
+    # uwsgi workers see the same history. Only the last max_turns turns of a
+    # session are kept, and turns older than ttl seconds are evicted.
+    def __init__(self, path: str, max_turns: int = 5, ttl: float = 3600, evict_interval: float = 60):
+        self.path = path
+        self.max_turns = max_turns
+        self.ttl = ttl
+        self.evict_interval = evict_interval
+        self._last_evicted = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS turns ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " session_id TEXT NOT NULL,"
+                " question TEXT NOT NULL,"
+                " answer TEXT NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS turns_session ON turns (session_id, id)")
+            conn.execute("CREATE INDEX IF NOT EXISTS turns_created ON turns (created_at)")
+
+    @contextmanager
+    def _connect(self):
+        # A short-lived connection per call is safe across threads and forks
+        conn = sqlite3.connect(self.path, timeout=10)
+        try:
+            with conn:
+                yield conn
+        finally:
+            conn.close()
+
+    def history(self, session_id: str):
+        with self._connect() as conn:
+            rows = conn.execute(
+                "SELECT question, answer FROM turns WHERE session_id = ? AND created_at >= ?"
+                " ORDER BY id DESC LIMIT ?",
+                (session_id, time.time() - self.ttl, self.max_turns),
+            ).fetchall()
+        return list(reversed(rows))
+
+    def append(self, session_id: str, question: str, answer: str):
+        now = time.time()
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT INTO turns (session_id, question, answer, created_at) VALUES (?, ?, ?, ?)",
+                (session_id, question, answer, now),
+            )
+            conn.execute(
+                "DELETE FROM turns WHERE session_id = ? AND id NOT IN"
+                " (SELECT id FROM turns WHERE session_id = ? ORDER BY id DESC LIMIT ?)",
+                (session_id, session_id, self.max_turns),
+            )
+            if now - self._last_evicted > self.evict_interval:
+                self._last_evicted = now
+                conn.execute("DELETE FROM turns WHERE created_at < ?", (now - self.ttl,))
+
+    def clear(self, session_id: str = None):
+        with self._connect() as conn:
+            if session_id is None:
+                conn.execute("DELETE FROM turns")
+            else:
+                conn.execute("DELETE FROM turns WHERE session_id = ?", (session_id,))
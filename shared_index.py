@@ -0,0 +1,62 @@
+import os
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class IndexVersion:
+    # Version stamp and write lock for an index directory shared by several
+    # worker processes. Writers hold the lock while they change the index and
+    # bump the stamp afterwards; readers compare the stamp with the version
+    # they loaded to know when to reopen.
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, "VERSION")
+        self.lock_path = os.path.join(directory, "write.lock")
+        # Fallback for platforms without fcntl, where only threads of one
+        # process are kept apart
+        self._thread_lock = threading.Lock()
+
+    def read(self):
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                return int(f.read().strip() or 0)
+        except FileNotFoundError:
+            return 0
+
+    def bump(self):
+        # Call with the write lock held
+        version = self.read() + 1
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(str(version))
+        os.replace(tmp_path, self.path)
+        return version
+
+    @contextmanager
+    def write_lock(self, blocking: bool = True):
+        # Yields whether the lock was acquired; with blocking=True it always is
+        if fcntl is None:
+            acquired = self._thread_lock.acquire(blocking)
+            try:
+                yield acquired
+            finally:
+                if acquired:
+                    self._thread_lock.release()
+            return
+
+        with open(self.lock_path, "a") as lock_file:
+            flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+            try:
+                fcntl.flock(lock_file, flags)
+            except BlockingIOError:
+                yield False
+                return
+            try:
+                yield True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
@@ -0,0 +1,159 @@
+# Per-request traces. A trace is started for each question and each
+# ingested document, carries the request id, and collects one span per
+# pipeline stage plus attributes such as the retrieved chunk ids and token
+# counts. Finished traces are appended to a JSON lines file, and those
+# slower than the threshold are also printed with their full breakdown.
+import json
+import os
+import re
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from metrics import STAGE_SECONDS
+
+_current = ContextVar("trace", default=None)
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9._-]{1,64}$")
+
+
+def new_request_id(value: str = None):
+    # Keeps a caller's id (e.g. an X-Request-ID header) if it is safe to
+    # log and to use in file names, otherwise makes a new one
+    if value and REQUEST_ID_PATTERN.match(value) and value.strip("."):
+        return value
+    return uuid.uuid4().hex
+
+
+class Trace:
+    def __init__(self, operation: str, request_id: str = None, **attributes):
+        self.operation = operation
+        self.request_id = new_request_id(request_id)
+        self.attributes = dict(attributes)
+        self.spans = []
+        self.started_at = time.time()
+        self._start = time.perf_counter()
+        self._lock = threading.Lock()
+
+    def add_span(self, name: str, seconds: float, start: float = None, **attributes):
+        span = {
+            "name": name,
+            # Offset from the start of the trace; None for stages that are
+            # measured as a total over many small steps
+            "start_ms": None if start is None else round((start - self._start) * 1000, 3),
+            "duration_ms": round(seconds * 1000, 3),
+        }
+        if attributes:
+            span["attributes"] = attributes
+        with self._lock:
+            self.spans.append(span)
+
+    def annotate(self, **attributes):
+        with self._lock:
+            self.attributes.update(attributes)
+
+    def add(self, name: str, amount: float):
+        with self._lock:
+            self.attributes[name] = self.attributes.get(name, 0) + amount
+
+    def to_dict(self, duration: float):
+        with self._lock:
+            return {
+                "request_id": self.request_id,
+                "operation": self.operation,
+                "pid": os.getpid(),
+                "started_at": self.started_at,
+                "duration_ms": round(duration * 1000, 3),
+                "attributes": dict(self.attributes),
+                "spans": list(self.spans),
+            }
+
+
+def current_trace():
+    return _current.get()
+
+
+@contextmanager
+def span(name: str, **attributes):
+    # Times a stage for the current trace, if any, and for the stage
+    # histogram in metrics.py
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_span(name, time.perf_counter() - start, start, **attributes)
+
+
+def record_span(name: str, seconds: float, start: float = None, **attributes):
+    STAGE_SECONDS.observe(seconds, stage=name)
+    trace = _current.get()
+    if trace is not None:
+        trace.add_span(name, seconds, start, **attributes)
+
+
+def annotate(**attributes):
+    trace = _current.get()
+    if trace is not None:
+        trace.annotate(**attributes)
+
+
+def add(name: str, amount: float):
+    trace = _current.get()
+    if trace is not None:
+        trace.add(name, amount)
+
+
+class Tracer:
+    # path=None keeps traces in memory only; slow_seconds=None turns the
+    # slow request log off
+    def __init__(self, path: str = None, slow_seconds: float = None):
+        self.path = path
+        self.slow_seconds = slow_seconds
+        self._lock = threading.Lock()
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    @contextmanager
+    def trace(self, operation: str, request_id: str = None, **attributes):
+        # The trace stays current across yields when used in a generator,
+        # and asyncio.to_thread() carries it into the worker thread
+        trace = Trace(operation, request_id, **attributes)
+        previous = _current.get()
+        _current.set(trace)
+        try:
+            yield trace
+        except BaseException as e:
+            # Includes a question cancelled at its deadline or a stream the
+            # client stopped reading
+            trace.annotate(error=str(e) or type(e).__name__)
+            raise
+        finally:
+            # set() rather than reset(): a streamed response may be closed
+            # from a different context than the one it started in
+            _current.set(previous)
+            self.finish(trace)
+
+    def finish(self, trace):
+        record = trace.to_dict(time.perf_counter() - trace._start)
+        slow = self.slow_seconds is not None and record["duration_ms"] >= self.slow_seconds * 1000
+        record["slow"] = slow
+        if self.path:
+            line = json.dumps(record, default=str) + "\n"
+            try:
+                # One write per line, so lines from several workers appending
+                # to the same file do not interleave
+                with self._lock, open(self.path, "a", encoding="utf-8") as f:
+                    f.write(line)
+            except OSError as e:
+                print(f"Could not write trace {trace.request_id}: {e}")
+        if slow:
+            print(format_slow(record))
+
+
+def format_slow(record):
+    spans = ", ".join(f"{span['name']} {span['duration_ms'] / 1000:.2f}s" for span in record["spans"])
+    attributes = " ".join(f"{name}={value}" for name, value in sorted(record["attributes"].items()))
+    return (
+        f"Slow {record['operation']} {record['request_id']}: {record['duration_ms'] / 1000:.2f}s "
+        f"[{spans}] {attributes}"
+    )
@@ -0,0 +1,141 @@
+# Watches DOCUMENTS_FOLDER and keeps the index in step with it. Events are
+# debounced and coalesced, so a sync that drops hundreds of PDFs at once
+# becomes one ingest_many() run rather than hundreds of single ingests.
+# Run it on its own next to the web workers:
+#   python watcher.py
+# or set WATCH_DOCUMENTS=1 to have one web worker run it (see app.py).
+import os
+import threading
+import time
+from watchdog.events import FileSystemEventHandler
+from watchdog.observers import Observer
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class FolderWatcher(FileSystemEventHandler):
+    # Pending operations are keyed by path, so the last event for a file
+    # wins. A batch is flushed once no event has arrived for `debounce`
+    # seconds, or `max_delay` seconds after its first event during a long
+    # burst.
+    def __init__(self, assistant, folder: str, debounce: float = 2.0, max_delay: float = 30.0, workers: int = None):
+        self.assistant = assistant
+        self.folder = folder
+        self.debounce = debounce
+        self.max_delay = max_delay
+        self.workers = workers
+        self._pending = {}
+        self._first_event = None
+        self._last_event = None
+        self._condition = threading.Condition()
+        self._observer = None
+        self._stopped = False
+
+    def start(self):
+        self._observer = Observer()
+        self._observer.schedule(self, self.folder, recursive=False)
+        self._observer.start()
+        threading.Thread(target=self._run, name="folder-watcher", daemon=True).start()
+        print(f"Watching {self.folder} for document changes")
+
+    def stop(self):
+        with self._condition:
+            self._stopped = True
+            self._condition.notify()
+        if self._observer:
+            self._observer.stop()
+            self._observer.join()
+
+    def _queue(self, path: str, operation: str):
+        if not path.lower().endswith(".pdf"):
+            return
+        with self._condition:
+            now = time.monotonic()
+            self._pending[path] = operation
+            self._first_event = self._first_event or now
+            self._last_event = now
+            self._condition.notify()
+
+    def on_created(self, event):
+        if not event.is_directory:
+            self._queue(event.src_path, "ingest")
+
+    def on_modified(self, event):
+        if not event.is_directory:
+            self._queue(event.src_path, "ingest")
+
+    def on_moved(self, event):
+        # Uploads and sync tools write a temporary file and rename it
+        if not event.is_directory:
+            self._queue(event.src_path, "delete")
+            self._queue(event.dest_path, "ingest")
+
+    def on_deleted(self, event):
+        if not event.is_directory:
+            self._queue(event.src_path, "delete")
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._stopped:
+                    if self._pending:
+                        now = time.monotonic()
+                        due = min(self._last_event + self.debounce, self._first_event + self.max_delay)
+                        if now >= due:
+                            break
+                        self._condition.wait(due - now)
+                    else:
+                        self._condition.wait()
+                if self._stopped:
+                    return
+                batch = self._pending
+                self._pending = {}
+                self._first_event = self._last_event = None
+            try:
+                self._flush(batch)
+            except Exception as e:
+                print(f"Error while applying document changes: {e}")
+
+    def _flush(self, batch):
+        start_time = time.time()
+        ingest_paths = [path for path, operation in batch.items() if operation == "ingest" and os.path.exists(path)]
+        # A file that is gone by now is deleted, whatever its last event was
+        deleted = [path for path in batch if not os.path.exists(path)]
+        for path in deleted:
+            self.assistant.delete_document(os.path.basename(path))
+        if ingest_paths:
+            self.assistant.ingest_many(ingest_paths, workers=self.workers)
+        print(f"Applied {len(ingest_paths)} changed and {len(deleted)} deleted documents. Time taken: {time.time() - start_time:.2f} seconds")
+
+
+def start_in_one_process(assistant, folder: str, lock_path: str, retry_interval: float = 30.0, **options):
+    # Several web workers may call this; the one holding lock_path runs the
+    # watcher, the others keep retrying in case that worker goes away
+    def acquire():
+        lock_file = open(lock_path, "a")
+        while True:
+            try:
+                if fcntl:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                # Held for the life of the process
+                FolderWatcher(assistant, folder, **options).start()
+                return
+            except BlockingIOError:
+                time.sleep(retry_interval)
+
+    threading.Thread(target=acquire, name="folder-watcher-lock", daemon=True).start()
+
+
+if __name__ == "__main__":
+    from app import assistant, DOCUMENTS_FOLDER, INDEX_FOLDER, BULK_INGEST_WORKERS, initialize_assistant
+
+    initialize_assistant()
+    # Same lock as the in-process watcher, so only one of them runs
+    start_in_one_process(
+        assistant, DOCUMENTS_FOLDER, os.path.join(INDEX_FOLDER, "watcher.lock"), workers=BULK_INGEST_WORKERS
+    )
+    while True:
+        time.sleep(1)